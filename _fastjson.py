@@ -0,0 +1,61 @@
+"""
+JSON backend shared by the tool path, chat and memory.
+
+Uses orjson or msgspec when installed, the standard library otherwise.
+Output is always compact and keeps non-ASCII characters as is, whichever backend is used.
+"""
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+if orjson is not None:
+    BACKEND = 'orjson'
+elif msgspec is not None:
+    BACKEND = 'msgspec'
+else:
+    BACKEND = 'json'
+
+def _stdlib_dumpb(obj) -> bytes:
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+if orjson is not None:
+    def dumpb(obj) -> bytes:
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            # e.g. integers over 64 bits, which the standard library handles
+            return _stdlib_dumpb(obj)
+
+    loads = orjson.loads
+elif msgspec is not None:
+    _encoder = msgspec.json.Encoder()
+    _decoder = msgspec.json.Decoder()
+
+    def dumpb(obj) -> bytes:
+        try:
+            return _encoder.encode(obj)
+        except (TypeError, msgspec.EncodeError):
+            return _stdlib_dumpb(obj)
+
+    def loads(data: str | bytes):
+        return _decoder.decode(data)
+else:
+    dumpb = _stdlib_dumpb
+    loads = json.loads
+
+def dumps(obj) -> str:
+    return dumpb(obj).decode('utf-8')
+
+__all__ = [
+    'BACKEND',
+    'dumps',
+    'dumpb',
+    'loads'
+]
@@ -0,0 +1,226 @@
+"""
+Client-side runtime of local Ollama models: a priority queue in front of the server's parallel slots,
+and streams whose usage is estimated when the server sends none.
+"""
+from __future__ import annotations
+
+from . import _fastjson
+
+from contextvars import ContextVar
+from typing import Any, Callable
+import asyncio
+import heapq
+import itertools
+import re
+import threading
+import time
+
+from openai.types import CompletionUsage
+
+# The priority of the requests sent in the current context, see `Ollama.priority`
+priority_var: ContextVar[int] = ContextVar('crazyagent_ollama_priority', default=0)
+
+# CJK characters, kana, hangul and full-width forms are about one token each
+_WIDE = re.compile(r'[\u2e80-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]')
+
+def estimate_tokens(text: str) -> int:
+    """A rough token count: one per wide character and one per four other characters."""
+    wide = len(_WIDE.findall(text))
+    return wide + (len(text) - wide + 3) // 4
+
+def estimate_input_tokens(messages: list, tools: list | None) -> int:
+    tokens = estimate_tokens(_fastjson.dumps(messages))
+    if tools:
+        tokens += estimate_tokens(_fastjson.dumps(tools))
+    return tokens
+
+class _Waiter:
+
+    __slots__ = (
+        'wake',
+        'granted'
+    )
+
+    def __init__(self, wake: Callable[[], None]):
+        self.wake = wake
+        self.granted = False
+
+def _set_result(future: asyncio.Future) -> None:
+    if not future.done():
+        future.set_result(None)
+
+class PriorityLimiter:
+
+    def __init__(self, limit: int = None):
+        """
+        At most `limit` holders at a time, shared by threads and event loops. Waiters with the highest
+        priority go first, then the oldest; a released slot is handed directly to the next waiter.
+
+        Args:
+            limit: None means no limit, the holders are only counted.
+        """
+        self.limit = limit
+        self.active = 0
+        self.served = 0
+        # Summed and longest time spent waiting for a slot
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+        # Heap of (-priority, arrival, waiter)
+        self._waiters: list[tuple[int, int, _Waiter]] = []
+        self._arrivals = itertools.count()
+        self._lock = threading.Lock()
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    def _enter(self, priority: int, wake: Callable[[], None]) -> _Waiter | None:
+        """Take a slot if one is free and nobody waits, else queue a waiter."""
+        with self._lock:
+            if not self._waiters and (self.limit is None or self.active < self.limit):
+                self.active += 1
+                self.served += 1
+                return None
+            waiter = _Waiter(wake)
+            heapq.heappush(self._waiters, (-priority, next(self._arrivals), waiter))
+            return waiter
+
+    def _cancel(self, waiter: _Waiter) -> bool:
+        """Stop waiting, return False if the slot was granted in the meantime."""
+        with self._lock:
+            if waiter.granted:
+                return False
+            self._waiters = [w for w in self._waiters if w[2] is not waiter]
+            heapq.heapify(self._waiters)
+            return True
+
+    def _waited(self, started: float) -> None:
+        waited = time.monotonic() - started
+        self.wait_time += waited
+        self.max_wait = max(self.max_wait, waited)
+
+    def acquire(self, priority: int = 0, timeout: float = None) -> None:
+        """Wait for a slot, raise `asyncio.TimeoutError` after `timeout` seconds."""
+        event = threading.Event()
+        waiter = self._enter(priority, event.set)
+        if waiter is None:
+            return
+        started = time.monotonic()
+        if not event.wait(timeout) and self._cancel(waiter):
+            raise asyncio.TimeoutError('Timed out waiting for a free slot of the model')
+        self._waited(started)
+
+    async def aacquire(self, priority: int = 0, timeout: float = None) -> None:
+        """Wait for a slot without blocking the event loop, raise `asyncio.TimeoutError` after `timeout` seconds."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        waiter = self._enter(priority, lambda: loop.call_soon_threadsafe(_set_result, future))
+        if waiter is None:
+            return
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(future, timeout)
+        except BaseException:
+            # Timed out or cancelled, a slot granted in the meantime is passed on
+            if not self._cancel(waiter):
+                self.release()
+            raise
+        self._waited(started)
+
+    def release(self) -> None:
+        with self._lock:
+            if self._waiters:
+                _, _, waiter = heapq.heappop(self._waiters)
+                waiter.granted = True
+                self.served += 1
+            else:
+                self.active -= 1
+                return
+        waiter.wake()
+
+class _MeteredStream:
+    """
+    Holds a slot of the limiter until the model finishes, and puts a usage on the last chunk: the one
+    the server sends after it if any, else an estimate from the lengths of the request and the output.
+    The request is only serialized for the estimate when the server sends no usage.
+    """
+
+    def __init__(self, stream, release: Callable[[], None], messages: list, tools: list | None):
+        self._stream = stream
+        self._release = release
+        self._messages = messages
+        self._tools = tools
+        self._output_tokens = 0
+
+    def release(self) -> None:
+        if self._release is not None:
+            release, self._release = self._release, None
+            release()
+
+    def _count(self, chunk) -> bool:
+        """Count the output of the chunk, return whether it is the last one."""
+        choice = chunk.choices[0]
+        if choice.delta.content:
+            self._output_tokens += estimate_tokens(choice.delta.content)
+        for tool_call in choice.delta.tool_calls or ():
+            self._output_tokens += estimate_tokens((tool_call.function.name or '') + (tool_call.function.arguments or ''))
+        return choice.finish_reason is not None
+
+    def _finish(self, chunk, usage: CompletionUsage | None) -> Any:
+        self.release()
+        if usage is None:
+            input_tokens = estimate_input_tokens(self._messages, self._tools)
+            usage = CompletionUsage(
+                prompt_tokens=input_tokens,
+                completion_tokens=self._output_tokens,
+                total_tokens=input_tokens + self._output_tokens
+            )
+        chunk.usage = usage
+        return chunk
+
+class MeteredStream(_MeteredStream):
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            # Chunks without choices only carry usage
+            while not (chunk := next(self._stream)).choices:
+                pass
+            if self._count(chunk):
+                usage = chunk.usage
+                for rest in self._stream:
+                    usage = rest.usage or usage
+                chunk = self._finish(chunk, usage)
+            return chunk
+        except BaseException:
+            self.release()
+            raise
+
+    def close(self) -> None:
+        self.release()
+        self._stream.close()
+
+class AsyncMeteredStream(_MeteredStream):
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            while not (chunk := await self._stream.__anext__()).choices:
+                pass
+            if self._count(chunk):
+                usage = chunk.usage
+                async for rest in self._stream:
+                    usage = rest.usage or usage
+                chunk = self._finish(chunk, usage)
+            return chunk
+        except BaseException:
+            self.release()
+            raise
+
+    async def close(self) -> None:
+        self.release()
+        await self._stream.close()
@@ -6,13 +6,18 @@ class Response:
         'content',
         'stop_usage',
         'tool_calls_info',
+        'tool_chunk',
+        'stop_reason',
     )
 
-    def __init__(self, content: str = '', stop_usage: dict = None):
+    def __init__(self, content: str = '', stop_usage: dict = None, tool_chunk: dict = None):
         """
         Args:
             content: The (chunk) content of the response.
 
+            tool_chunk: A partial result of a generator tool, only in stream mode.
+                e.g.: {'name': 'search_image', 'chunk': ['https://...', ...]}
+
             stop_usage: The usage information of the response.
                 e.g.: {
                     'input_tokens': 100,
@@ -20,6 +25,9 @@ class Response:
                     'total_tokens': 200,
                 }
 
+            *stop_reason: None if the turn completed, otherwise the limit of its `Budget` which cut it:
+                'timeout', 'max_tool_calls', 'max_tokens' or 'cancelled'.
+
             *tool_calls_info: The information of the tool calls.
                 e.g.: [
                     {
@@ -38,6 +46,8 @@ class Response:
         self.content: str = content
         self.stop_usage: dict = stop_usage
         self.tool_calls_info: list[dict] = []
+        self.tool_chunk: dict = tool_chunk
+        self.stop_reason: str = None
 
     def add_tool_call_info(
         self,
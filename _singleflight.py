@@ -0,0 +1,116 @@
+"""
+Single-flight coalescing of identical concurrent provider calls: while a call is in flight,
+callers with the same request attach to it instead of sending their own.
+"""
+from __future__ import annotations
+
+from . import _fastjson
+
+from typing import Any, AsyncIterator, Awaitable, Callable
+import asyncio
+
+class SharedStreamCancelledError(Exception):
+    """Raised to the subscribers of a shared stream whose reading was cancelled before it ended."""
+
+class _SharedStream:
+    """Reads a provider stream once and replays every chunk, from the first one, to each subscriber."""
+
+    def __init__(self, open_stream: Callable[[], Awaitable[Any]]):
+        self._chunks: list = []
+        self._done = False
+        self._error: Exception = None
+        self._changed = asyncio.Condition()
+        self._subscribers = 0
+        # Set once the last subscriber left early, later callers must not join it
+        self.abandoned = False
+        # Runs on its own, so the other subscribers still get the chunks if the first caller goes away
+        self.task = asyncio.ensure_future(self._pump(open_stream))
+
+    async def _pump(self, open_stream: Callable[[], Awaitable[Any]]) -> None:
+        stream = None
+        try:
+            stream = await open_stream()
+            async for chunk in stream:
+                async with self._changed:
+                    self._chunks.append(chunk)
+                    self._changed.notify_all()
+        except Exception as e:
+            self._error = e
+        except asyncio.CancelledError:
+            # The subscribers left must not take the chunks so far for a complete response
+            self._error = SharedStreamCancelledError('The shared provider stream was cancelled before it ended')
+            raise
+        finally:
+            if stream is not None:
+                # Releases the connection when the stream is left before its end
+                await stream.close()
+            async with self._changed:
+                self._done = True
+                self._changed.notify_all()
+
+    def subscribe(self) -> AsyncIterator:
+        # Counted here rather than in the generator, which only starts on the first iteration
+        self._subscribers += 1
+        return self._replay()
+
+    async def _replay(self) -> AsyncIterator:
+        i = 0
+        try:
+            while True:
+                if i == len(self._chunks):
+                    async with self._changed:
+                        await self._changed.wait_for(lambda: i < len(self._chunks) or self._done)
+                while i < len(self._chunks):
+                    yield self._chunks[i]
+                    i += 1
+                if self._done and i == len(self._chunks):
+                    if self._error is not None:
+                        raise self._error
+                    return
+        finally:
+            self._subscribers -= 1
+            if self._subscribers == 0 and not self._done:
+                # Nobody reads the rest, stop downloading it
+                self.abandoned = True
+                self.task.cancel()
+
+class SingleFlight:
+
+    def __init__(self):
+        self._calls: dict[bytes, asyncio.Future] = {}
+        self._streams: dict[bytes, _SharedStream] = {}
+        # Number of provider calls saved
+        self.coalesced = 0
+
+    @staticmethod
+    def key(**request) -> bytes:
+        """Requests with the same model, messages, tools, temperature... have the same key."""
+        return _fastjson.dumpb(request)
+
+    def _release(self, flights: dict, key: bytes, flight) -> None:
+        # A later call with the same key may already be in flight
+        if flights.get(key) is flight:
+            del flights[key]
+
+    async def call(self, key: bytes, create: Callable[[], Awaitable[Any]]) -> Any:
+        """Return the result of `create()`, shared with the concurrent calls with the same key."""
+        flight = self._calls.get(key)
+        if flight is None:
+            flight = asyncio.ensure_future(create())
+            self._calls[key] = flight
+            flight.add_done_callback(lambda f: self._release(self._calls, key, f))
+        else:
+            self.coalesced += 1
+        # A cancelled caller must not cancel the call of the others
+        return await asyncio.shield(flight)
+
+    def stream(self, key: bytes, open_stream: Callable[[], Awaitable[Any]]) -> AsyncIterator:
+        """Iterate the chunks of `await open_stream()`, shared with the concurrent streams with the same key."""
+        shared = self._streams.get(key)
+        if shared is None or shared.abandoned:
+            shared = _SharedStream(open_stream)
+            self._streams[key] = shared
+            shared.task.add_done_callback(lambda _: self._release(self._streams, key, shared))
+        else:
+            self.coalesced += 1
+        return shared.subscribe()
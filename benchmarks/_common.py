@@ -0,0 +1,97 @@
+"""Helpers shared by the benchmark scripts."""
+from __future__ import annotations
+
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+
+try:
+    import crazyagent
+except ImportError:
+    # Running from a source checkout, where the repository root is the package itself
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+    import crazyagent
+
+class Recorder:
+    """Collects benchmark results and writes them as machine-readable JSON."""
+
+    def __init__(self, suite: str):
+        self.suite = suite
+        self.results: list[dict] = []
+
+    def add(self, name: str, value: float, unit: str, **params) -> None:
+        self.results.append({'name': name, 'value': value, 'unit': unit, 'params': params})
+        shown = ', '.join(f'{k}={v}' for k, v in params.items())
+        print(f'{name:<40} {value:>14.3f} {unit:<8} {shown}', file=sys.stderr)
+
+    def add_samples(self, name: str, samples: list[float], unit: str = 'ms', scale: float = 1e3, **params) -> None:
+        """Record the median and 95th percentile of a list of durations in seconds."""
+        samples = sorted(samples)
+        self.add(f'{name}.p50', statistics.median(samples) * scale, unit, **params)
+        self.add(f'{name}.p95', samples[min(len(samples) - 1, int(len(samples) * 0.95))] * scale, unit, **params)
+
+    def document(self) -> dict:
+        return {
+            'suite': self.suite,
+            'timestamp': time.time(),
+            'crazyagent': crazyagent.__version__,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'results': self.results
+        }
+
+    def write(self, path: str | None) -> None:
+        """Write to `path`, or to stdout if it is None or '-'."""
+        data = json.dumps(self.document(), ensure_ascii=False, indent=2)
+        if path in (None, '-'):
+            print(data)
+        else:
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(data)
+
+# Units for which a higher value is better, every other unit is a cost
+_HIGHER_IS_BETTER = {'req/s'}
+
+def load(path: str) -> dict:
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+def compare(current: dict, baseline: dict, threshold: float = 0.1) -> list[dict]:
+    """
+    Print the change of each result present in both documents.
+
+    Args:
+        current: The document of this run, as returned by `Recorder.document`.
+
+        baseline: The document of a previous run, e.g. of the previous release.
+
+        threshold: The relative change beyond which a result counts as a regression.
+
+    Returns:
+        The regressed results.
+    """
+    def key(r: dict) -> tuple:
+        return r['name'], tuple(sorted(r['params'].items()))
+
+    previous = {key(r): r for r in baseline['results']}
+    regressions = []
+    print(f'{"":<48} {baseline.get("crazyagent", "baseline"):>14} {current.get("crazyagent", "current"):>14}', file=sys.stderr)
+    for r in current['results']:
+        b = previous.get(key(r))
+        if b is None or r['unit'] != b['unit']:
+            continue
+        if b['value']:
+            change = (r['value'] - b['value']) / abs(b['value'])
+        else:
+            change = 0.0 if not r['value'] else float('inf')
+        worse = -change if r['unit'] in _HIGHER_IS_BETTER else change
+        flag = '  REGRESSION' if worse > threshold else ''
+        if flag:
+            regressions.append(r)
+        shown = ', '.join(f'{k}={v}' for k, v in r['params'].items())
+        label = f'{r["name"]} ({shown})' if shown else r['name']
+        print(f'{label:<48} {b["value"]:>14.3f} {r["value"]:>14.3f} {r["unit"]:<6} {change:+8.1%}{flag}', file=sys.stderr)
+    return regressions
@@ -0,0 +1,159 @@
+"""
+End-to-end benchmarks of `Chat` against a local mock server, no network or API key needed.
+
+Measures, for each provider usage format:
+    - throughput and latency of invoke / stream / ainvoke / astream,
+    - time to first token of stream / astream,
+    - overhead of one tool-call round trip,
+    - cost of Memory.dumps / Memory.loads at varying history sizes.
+
+Usage:
+    python -m benchmarks.bench_chat --providers deepseek kimi ollama --requests 50 --output results.json
+"""
+from ._common import Recorder
+from .mock_server import MockConfig, MockServer, PROVIDERS
+
+from crazyagent.chat import CloseAI, Deepseek, Moonshot, Ollama, Chat
+from crazyagent.memory import Memory, HumanMessage, AIMessage, AICallToolMessage, ToolMessage
+from crazyagent.toolkit.core import crazy_tool, Argument
+
+import argparse
+import asyncio
+import time
+
+_CHAT_CLASSES = {
+    'deepseek': Deepseek,
+    'openai': CloseAI,
+    'kimi': Moonshot,
+    'ollama': Ollama,
+}
+
+@crazy_tool
+def echo(text: str = Argument('Text to echo')) -> str:
+    """Return the text as is."""
+    return text
+
+def make_chat(provider: str, server: MockServer) -> Chat:
+    cls = _CHAT_CLASSES[provider]
+    if cls is Ollama:
+        return Ollama(model='mock', base_url=server.base_url)
+    return cls(api_key='mock', base_url=server.base_url)
+
+def bench_sync(recorder: Recorder, llm: Chat, provider: str, n: int) -> None:
+    samples = []
+    start = time.perf_counter()
+    for _ in range(n):
+        t = time.perf_counter()
+        llm.invoke('hello')
+        samples.append(time.perf_counter() - t)
+    recorder.add('invoke.throughput', n / (time.perf_counter() - start), 'req/s', provider=provider)
+    recorder.add_samples('invoke.latency', samples, provider=provider)
+
+    samples, ttfts = [], []
+    start = time.perf_counter()
+    for _ in range(n):
+        t = time.perf_counter()
+        first = None
+        for response in llm.stream('hello'):
+            if first is None and response.content:
+                first = time.perf_counter() - t
+        ttfts.append(first)
+        samples.append(time.perf_counter() - t)
+    recorder.add('stream.throughput', n / (time.perf_counter() - start), 'req/s', provider=provider)
+    recorder.add_samples('stream.latency', samples, provider=provider)
+    recorder.add_samples('stream.ttft', ttfts, provider=provider)
+
+async def bench_async(recorder: Recorder, llm: Chat, provider: str, n: int, concurrency: int) -> None:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one_ainvoke() -> float:
+        async with semaphore:
+            t = time.perf_counter()
+            await llm.ainvoke('hello')
+            return time.perf_counter() - t
+
+    async def one_astream() -> tuple[float, float]:
+        async with semaphore:
+            t = time.perf_counter()
+            first = None
+            async for response in llm.astream('hello'):
+                if first is None and response.content:
+                    first = time.perf_counter() - t
+            return time.perf_counter() - t, first
+
+    start = time.perf_counter()
+    samples = await asyncio.gather(*[one_ainvoke() for _ in range(n)])
+    recorder.add('ainvoke.throughput', n / (time.perf_counter() - start), 'req/s', provider=provider, concurrency=concurrency)
+    recorder.add_samples('ainvoke.latency', samples, provider=provider, concurrency=concurrency)
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*[one_astream() for _ in range(n)])
+    recorder.add('astream.throughput', n / (time.perf_counter() - start), 'req/s', provider=provider, concurrency=concurrency)
+    recorder.add_samples('astream.latency', [r[0] for r in results], provider=provider, concurrency=concurrency)
+    recorder.add_samples('astream.ttft', [r[1] for r in results], provider=provider, concurrency=concurrency)
+
+def bench_tool_loop(recorder: Recorder, llm: Chat, server: MockServer, provider: str, n: int) -> None:
+    """A turn with one tool call costs two completions, the overhead is what remains beyond them."""
+    server.config.tool_calls = False
+    t = time.perf_counter()
+    for _ in range(n):
+        llm.invoke('hello', tools=[echo])
+    plain = (time.perf_counter() - t) / n
+
+    server.config.tool_calls = True
+    t = time.perf_counter()
+    for _ in range(n):
+        llm.invoke('hello', tools=[echo])
+    with_tool = (time.perf_counter() - t) / n
+    recorder.add('tool_loop.turn', with_tool * 1e3, 'ms', provider=provider)
+    recorder.add('tool_loop.overhead', (with_tool - 2 * plain) * 1e3, 'ms', provider=provider)
+
+def make_memory(size: int) -> Memory:
+    memory = Memory()
+    for i in range(size // 4):
+        memory.update(
+            HumanMessage(f'question {i} ' * 10),
+            AICallToolMessage(f'call_{i}', 'echo', '{"text":"%d"}' % i),
+            ToolMessage('{"result":"%d"}' % i, f'call_{i}'),
+            AIMessage(f'answer {i} ' * 20)
+        )
+    return memory
+
+def bench_memory_serialization(recorder: Recorder, sizes: list[int], repeat: int) -> None:
+    for size in sizes:
+        memory = make_memory(size)
+        t = time.perf_counter()
+        for _ in range(repeat):
+            data = memory.dumps()
+        recorder.add('memory.dumps', (time.perf_counter() - t) / repeat * 1e3, 'ms', messages=size)
+        t = time.perf_counter()
+        for _ in range(repeat):
+            Memory.loads(data)
+        recorder.add('memory.loads', (time.perf_counter() - t) / repeat * 1e3, 'ms', messages=size)
+        recorder.add('memory.snapshot_size', len(data) / 1024, 'KiB', messages=size)
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmarks of crazyagent Chat')
+    parser.add_argument('--providers', nargs='+', choices=PROVIDERS, default=['deepseek', 'kimi', 'ollama'])
+    parser.add_argument('--requests', type=int, default=50, help='Requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=10, help='Concurrent requests of the async scenarios')
+    parser.add_argument('--tokens', type=int, default=50, help='Tokens per reply')
+    parser.add_argument('--rate', type=float, default=0, help='Tokens per second when streaming, 0 for unlimited')
+    parser.add_argument('--latency', type=float, default=0, help='Seconds before the first byte')
+    parser.add_argument('--memory-sizes', type=int, nargs='+', default=[10, 1000, 10000])
+    parser.add_argument('--output', default='-', help='Path of the JSON results, - for stdout')
+    args = parser.parse_args()
+
+    recorder = Recorder('chat')
+    for provider in args.providers:
+        config = MockConfig(provider, args.tokens, args.rate, args.latency, tool_calls=False)
+        with MockServer(config) as server:
+            llm = make_chat(provider, server)
+            bench_sync(recorder, llm, provider, args.requests)
+            asyncio.run(bench_async(recorder, llm, provider, args.requests, args.concurrency))
+            bench_tool_loop(recorder, llm, server, provider, args.requests)
+    bench_memory_serialization(recorder, args.memory_sizes, repeat=5)
+    recorder.write(args.output)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,178 @@
+"""
+Micro-benchmarks and allocation profiles of the Memory / Message / Response hot path.
+
+Covers, at each history size:
+    - Memory.update, which type-checks its arguments,
+    - Memory.__iter__, which builds the 'messages' parameter of every request,
+    - the construction of each (type-checked) Message class,
+    - Response.total_tokens with as many tool calls,
+    - tracemalloc snapshots: bytes per stored message and the allocations of each operation.
+
+Only the API present in every release is used, so the same suite runs against an older version
+of the package to compare with it:
+    python -m crazyagent.benchmarks.bench_memory --output results.json
+    python -m crazyagent.benchmarks.bench_memory --compare v1.4.1        # any git ref, exported with git archive
+    python -m crazyagent.benchmarks.bench_memory --baseline previous.json
+"""
+from ._common import Recorder, compare, load
+
+from crazyagent.memory import Memory, SystemMessage, HumanMessage, AIMessage, AICallToolMessage, ToolMessage
+from crazyagent._response import Response
+
+import argparse
+import io
+import os
+import subprocess
+import sys
+import tarfile
+import tempfile
+import timeit
+import tracemalloc
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def make_memory(size: int, max_turns: int = 5) -> Memory:
+    memory = Memory(max_turns=max_turns)
+    memory.system_message = SystemMessage('You are a helpful assistant.')
+    for i in range(size // 4):
+        memory.update(
+            HumanMessage(f'question {i}'),
+            AICallToolMessage(f'call_{i}', 'echo', '{"text":"%d"}' % i),
+            ToolMessage('{"result":"%d"}' % i, f'call_{i}'),
+            AIMessage(f'answer {i}')
+        )
+    return memory
+
+def make_response(tool_calls: int) -> Response:
+    response = Response(stop_usage={'input_tokens': 10, 'output_tokens': 10, 'total_tokens': 20})
+    for i in range(tool_calls):
+        response.add_tool_call_info('echo', {'text': str(i)}, {'result': str(i)}, {'total_tokens': 20})
+    return response
+
+def per_call(stmt: callable, repeat: int) -> float:
+    """The best time of one call in microseconds, over `repeat` runs of an auto-ranged number of calls."""
+    timer = timeit.Timer(stmt)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat, number)) / number * 1e6
+
+def allocations(stmt: callable) -> tuple[int, int]:
+    """The peak traced bytes and the number of blocks still allocated by one call."""
+    stmt()  # warm up caches, e.g. of typeguard
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    tracemalloc.reset_peak()
+    base = tracemalloc.get_traced_memory()[0]
+    result = stmt()
+    peak = tracemalloc.get_traced_memory()[1] - base
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    del result
+    blocks = sum(stat.count_diff for stat in after.compare_to(before, 'filename'))
+    return peak, blocks
+
+def bench_update(recorder: Recorder, sizes: list[int], repeat: int) -> None:
+    batch = 1000
+    messages = (HumanMessage('question'), AIMessage('answer'))
+    for size in sizes:
+        timings = []
+        for _ in range(repeat):
+            memory = make_memory(size)
+            t = timeit.default_timer()
+            for _ in range(batch):
+                memory.update(*messages)
+            timings.append(timeit.default_timer() - t)
+        recorder.add('memory.update', min(timings) / batch * 1e6, 'us', messages=size)
+        peak, _ = allocations(lambda: memory.update(*messages))
+        recorder.add('memory.update.alloc_peak', peak, 'B', messages=size)
+
+def bench_iter(recorder: Recorder, sizes: list[int], repeat: int) -> None:
+    for size in sizes:
+        memory = make_memory(size)
+        recorder.add('memory.iter', per_call(lambda: list(memory), repeat), 'us', messages=size)
+        peak, _ = allocations(lambda: list(memory))
+        recorder.add('memory.iter.alloc_peak', peak, 'B', messages=size)
+
+def bench_footprint(recorder: Recorder, sizes: list[int]) -> None:
+    for size in sizes:
+        tracemalloc.start()
+        memory = make_memory(size)
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        recorder.add('memory.bytes_per_message', current / max(size, 1), 'B', messages=size)
+        recorder.add('memory.build.alloc_peak', peak / 1024, 'KiB', messages=size)
+        del memory
+
+def bench_messages(recorder: Recorder, repeat: int) -> None:
+    constructors = {
+        'SystemMessage': lambda: SystemMessage('You are a helpful assistant.'),
+        'HumanMessage': lambda: HumanMessage('question'),
+        'AIMessage': lambda: AIMessage('answer'),
+        'AICallToolMessage': lambda: AICallToolMessage('call_0', 'echo', '{"text":"0"}'),
+        'ToolMessage': lambda: ToolMessage('{"result":"0"}', 'call_0'),
+    }
+    for name, construct in constructors.items():
+        recorder.add('message.init', per_call(construct, repeat), 'us', cls=name)
+        message = construct()
+        recorder.add('message.dict', per_call(lambda: dict(message), repeat), 'us', cls=name)
+        _, blocks = allocations(construct)
+        recorder.add('message.init.blocks', blocks, 'blocks', cls=name)
+
+def bench_total_tokens(recorder: Recorder, sizes: list[int], repeat: int) -> None:
+    for size in sizes:
+        response = make_response(size)
+        recorder.add('response.total_tokens', per_call(lambda: response.total_tokens, repeat), 'us', tool_calls=size)
+        peak, _ = allocations(lambda: response.total_tokens)
+        recorder.add('response.total_tokens.alloc_peak', peak, 'B', tool_calls=size)
+
+def run(sizes: list[int], repeat: int) -> Recorder:
+    recorder = Recorder('memory')
+    bench_messages(recorder, repeat)
+    bench_update(recorder, sizes, repeat)
+    bench_iter(recorder, sizes, repeat)
+    bench_footprint(recorder, sizes)
+    bench_total_tokens(recorder, sizes, repeat)
+    return recorder
+
+def run_at_ref(ref: str, sizes: list[int], repeat: int) -> dict:
+    """Run this suite against the package as it was at a git ref, e.g. the previous release tag."""
+    archive = subprocess.run(['git', '-C', _ROOT, 'archive', '--format=tar', ref], capture_output=True, check=True).stdout
+    with tempfile.TemporaryDirectory() as tmp:
+        with tarfile.open(fileobj=io.BytesIO(archive)) as tar:
+            tar.extractall(os.path.join(tmp, 'crazyagent'))
+        output = os.path.join(tmp, 'results.json')
+        # Prepended, the dependencies may come from PYTHONPATH too
+        env = {**os.environ, 'PYTHONPATH': os.pathsep.join(filter(None, [tmp, os.environ.get('PYTHONPATH')]))}
+        # Run from the package directory, so `benchmarks` is this suite and `crazyagent` is the exported one
+        subprocess.run(
+            [sys.executable, '-m', 'benchmarks.bench_memory', '--sizes', *map(str, sizes),
+             '--repeat', str(repeat), '--output', output],
+            cwd=_ROOT, env=env, check=True
+        )
+        baseline = load(output)
+    baseline['crazyagent'] = ref
+    return baseline
+
+def main():
+    parser = argparse.ArgumentParser(description='Micro-benchmarks of the crazyagent Memory hot path')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 1000, 100000], help='Numbers of messages')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', default='-', help='Path of the JSON results, - for stdout')
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--compare', metavar='REF', help='Also run against this git ref and compare')
+    group.add_argument('--baseline', metavar='PATH', help='Compare with the JSON results of a previous run')
+    parser.add_argument('--threshold', type=float, default=0.1, help='Relative slowdown reported as a regression')
+    args = parser.parse_args()
+
+    recorder = run(args.sizes, args.repeat)
+    recorder.write(args.output)
+    if args.compare:
+        baseline = run_at_ref(args.compare, args.sizes, args.repeat)
+    elif args.baseline:
+        baseline = load(args.baseline)
+    else:
+        return
+    if compare(recorder.document(), baseline, args.threshold):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,234 @@
+"""
+A local stand-in for an OpenAI-compatible chat-completions server, for offline benchmarks.
+
+Standard library only. Speaks `POST /v1/chat/completions`, streaming (SSE) included, with:
+    - a configurable latency before the first byte and token rate,
+    - tool-call emission: when tools are given and the last message is from the user, the first tool is called,
+    - the usage format of each provider: 'deepseek'/'openai' (usage in the last chunk),
+      'kimi' (usage in the last choice) and 'ollama' (no usage when streaming).
+
+Run standalone:
+    python -m benchmarks.mock_server --port 8765 --provider deepseek --tokens 50 --rate 500
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import threading
+import time
+
+PROVIDERS = ('deepseek', 'openai', 'kimi', 'ollama')
+
+class MockConfig:
+
+    def __init__(
+        self,
+        provider: str = 'deepseek',
+        tokens: int = 50,
+        rate: float = 0,
+        latency: float = 0,
+        tool_calls: bool = True
+    ):
+        """
+        Args:
+            provider: The usage format to emulate, one of PROVIDERS.
+
+            tokens: The number of tokens of each text reply.
+
+            rate: Tokens per second when streaming, 0 for as fast as possible.
+
+            latency: Seconds before the first byte of each response.
+
+            tool_calls: Call the first tool when tools are given and the last message is from the user.
+        """
+        if provider not in PROVIDERS:
+            raise ValueError(f'provider must be one of {PROVIDERS}')
+        self.provider = provider
+        self.tokens = tokens
+        self.rate = rate
+        self.latency = latency
+        self.tool_calls = tool_calls
+
+_PLACEHOLDERS = {'string': 'x', 'integer': 1, 'number': 1, 'boolean': True, 'array': [], 'object': {}, 'null': None}
+
+def _tool_args(tool: dict) -> str:
+    """Arguments filled with placeholders for every parameter of the tool."""
+    properties = tool['function']['parameters']['properties']
+    args = {}
+    for name, schema in properties.items():
+        if 'default' in schema:
+            args[name] = schema['default']
+        elif 'enum' in schema:
+            args[name] = schema['enum'][0]
+        else:
+            t = schema['type'][0] if isinstance(schema['type'], list) else schema['type']
+            args[name] = _PLACEHOLDERS[t]
+    return json.dumps(args)
+
+class MockServer:
+
+    def __init__(self, config: MockConfig = None, host: str = '127.0.0.1', port: int = 0):
+        self.config = config or MockConfig()
+        self.host = host
+        self.port = port
+        self.requests = 0
+        self._loop: asyncio.AbstractEventLoop = None
+        self._server: asyncio.Server = None
+        self._thread: threading.Thread = None
+
+    @property
+    def base_url(self) -> str:
+        return f'http://{self.host}:{self.port}/v1'
+
+    # ---------------- HTTP ----------------
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while (line := await reader.readline()) not in (b'\r\n', b''):
+                    k, _, v = line.decode('latin-1').partition(':')
+                    headers[k.strip().lower()] = v.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                self.requests += 1
+                await self._respond(json.loads(body) if body else {}, writer)
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    async def _respond(self, request: dict, writer: asyncio.StreamWriter) -> None:
+        config = self.config
+        if config.latency:
+            await asyncio.sleep(config.latency)
+        messages = request.get('messages', [])
+        tools = request.get('tools')
+        call_tool = config.tool_calls and tools and messages and messages[-1]['role'] == 'user'
+        created = int(time.time())
+        base = {'id': f'chatcmpl-{self.requests}', 'created': created, 'model': request.get('model', 'mock')}
+        usage = {'prompt_tokens': sum(len(str(m.get('content') or '')) for m in messages) // 4 + 1,
+                 'completion_tokens': config.tokens, 'total_tokens': 0}
+        usage['total_tokens'] = usage['prompt_tokens'] + usage['completion_tokens']
+
+        if not request.get('stream'):
+            if call_tool:
+                message = {'role': 'assistant', 'content': None, 'tool_calls': [{
+                    'id': f'call_{self.requests}', 'type': 'function',
+                    'function': {'name': tools[0]['function']['name'], 'arguments': _tool_args(tools[0])}
+                }]}
+                finish_reason = 'tool_calls'
+            else:
+                message = {'role': 'assistant', 'content': 'tok ' * config.tokens}
+                finish_reason = 'stop'
+            payload = {**base, 'object': 'chat.completion', 'usage': usage,
+                       'choices': [{'index': 0, 'message': message, 'finish_reason': finish_reason}]}
+            data = json.dumps(payload).encode()
+            writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n'
+                         b'Content-Length: %d\r\n\r\n' % len(data) + data)
+            await writer.drain()
+            return
+
+        writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nTransfer-Encoding: chunked\r\n\r\n')
+
+        def chunk(delta: dict, finish_reason: str = None, last: bool = False) -> dict:
+            choice = {'index': 0, 'delta': delta, 'finish_reason': finish_reason}
+            c = {**base, 'object': 'chat.completion.chunk', 'choices': [choice]}
+            if last and config.provider in ('deepseek', 'openai'):
+                c['usage'] = usage
+            if last and config.provider == 'kimi':
+                choice['usage'] = usage
+            return c
+
+        async def send(c: dict) -> None:
+            data = b'data: ' + json.dumps(c).encode() + b'\n\n'
+            writer.write(b'%x\r\n%s\r\n' % (len(data), data))
+            await writer.drain()
+
+        interval = 1 / config.rate if config.rate else 0
+        if call_tool:
+            args = _tool_args(tools[0])
+            await send(chunk({'role': 'assistant', 'tool_calls': [{'index': 0, 'id': f'call_{self.requests}', 'type': 'function',
+                             'function': {'name': tools[0]['function']['name'], 'arguments': ''}}]}))
+            for i in range(0, len(args), 8):
+                await send(chunk({'tool_calls': [{'index': 0, 'function': {'arguments': args[i:i + 8]}}]}))
+            await send(chunk({}, 'tool_calls', last=True))
+        else:
+            await send(chunk({'role': 'assistant', 'content': ''}))
+            for _ in range(config.tokens):
+                if interval:
+                    await asyncio.sleep(interval)
+                await send(chunk({'content': 'tok '}))
+            await send(chunk({'content': ''}, 'stop', last=True))
+        data = b'data: [DONE]\n\n'
+        writer.write(b'%x\r\n%s\r\n0\r\n\r\n' % (len(data), data))
+        await writer.drain()
+
+    # ---------------- lifecycle ----------------
+
+    async def serve(self) -> None:
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    def start(self) -> MockServer:
+        """Serve in a background thread, returns once the server is listening."""
+        ready = threading.Event()
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            self._loop.run_until_complete(self.serve())
+            ready.set()
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=run, name='mock-openai-server', daemon=True)
+        self._thread.start()
+        ready.wait()
+        return self
+
+    async def _shutdown(self) -> None:
+        self._server.close()
+        tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stop(self) -> None:
+        if self._loop is not None:
+            asyncio.run_coroutine_threadsafe(self._shutdown(), self._loop).result()
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop.close()
+            self._loop = None
+
+    def __enter__(self) -> MockServer:
+        return self.start()
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
+
+def main():
+    parser = argparse.ArgumentParser(description='Mock OpenAI-compatible chat-completions server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--provider', choices=PROVIDERS, default='deepseek')
+    parser.add_argument('--tokens', type=int, default=50)
+    parser.add_argument('--rate', type=float, default=0)
+    parser.add_argument('--latency', type=float, default=0)
+    parser.add_argument('--no-tool-calls', action='store_true')
+    args = parser.parse_args()
+
+    config = MockConfig(args.provider, args.tokens, args.rate, args.latency, not args.no_tool_calls)
+    server = MockServer(config, args.host, args.port)
+
+    async def run():
+        await server.serve()
+        print(f'Mock server listening on {server.base_url}')
+        await asyncio.Event().wait()
+
+    asyncio.run(run())
+
+if __name__ == '__main__':
+    main()
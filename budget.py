@@ -0,0 +1,100 @@
+from __future__ import annotations
+
+from typing import Any, Awaitable, TYPE_CHECKING
+import asyncio
+import time
+
+if TYPE_CHECKING:
+    from ._response import Response
+
+class Budget:
+
+    def __init__(
+        self,
+        timeout: float = None,
+        max_tool_calls: int = None,
+        max_tokens: int = None
+    ):
+        """
+        Limits of one call of `invoke`/`stream`/`ainvoke`/`astream`. When one is hit, the call ends cleanly:
+        the turn keeps what was completed (the tool calls that returned, the text received so far),
+        or is rolled back if nothing was, and `response.stop_reason` tells which limit was hit.
+
+        Args:
+            timeout: The deadline of the whole call in seconds, model calls and tool calls included.
+                Async tools and streams are interrupted when it passes, sync tools are not.
+
+            max_tool_calls: The maximum number of tool calls, the next one is not run.
+
+            max_tokens: The budget of tokens of all the model calls of the turn, checked before each model call.
+                Streams of Ollama report no usage, their usage is estimated.
+
+        A budget is started again by each call it is passed to; don't share it between concurrent calls.
+        """
+        self.timeout = timeout
+        self.max_tool_calls = max_tool_calls
+        self.max_tokens = max_tokens
+        self.deadline: float = None
+        self.cancelled = False
+        # The provider call or async tool awaited by `run`
+        self._task: asyncio.Future = None
+
+    def start(self) -> Budget:
+        self.deadline = time.monotonic() + self.timeout if self.timeout is not None else None
+        self.cancelled = False
+        return self
+
+    def cancel(self) -> None:
+        """
+        Stop the call, e.g. from another thread when the user closes the page. An async provider call
+        or tool in flight is cancelled, otherwise the call stops at the next check.
+        """
+        self.cancelled = True
+        task = self._task
+        if task is not None:
+            task.get_loop().call_soon_threadsafe(task.cancel)
+
+    async def run(self, awaitable: Awaitable) -> Any:
+        """
+        Await a provider call or an async tool in a task of its own, so it can be interrupted: raises
+        `asyncio.TimeoutError` when the deadline passes and `asyncio.CancelledError` once `cancel` is called.
+        """
+        task = asyncio.ensure_future(awaitable)
+        self._task = task
+        if self.cancelled:
+            task.cancel()
+        try:
+            return await asyncio.wait_for(task, self.remaining())
+        finally:
+            self._task = None
+
+    def remaining(self) -> float | None:
+        """Seconds left before the deadline, None if there is none."""
+        if self.deadline is None:
+            return None
+        return max(self.deadline - time.monotonic(), 0)
+
+    def check_time(self) -> str | None:
+        """Cheap enough to run between two chunks of a stream."""
+        if self.cancelled:
+            return 'cancelled'
+        if self.deadline is not None and time.monotonic() >= self.deadline:
+            return 'timeout'
+        return None
+
+    def check(self, resp: Response) -> str | None:
+        """Run before each model call, returns the reason to stop if any."""
+        if (reason := self.check_time()) is not None:
+            return reason
+        if self.max_tokens is not None:
+            used = sum(t['usage']['total_tokens'] for t in resp.tool_calls_info)
+            if used >= self.max_tokens:
+                return 'max_tokens'
+        return None
+
+    def allows_tool_call(self, resp: Response) -> bool:
+        return self.max_tool_calls is None or len(resp.tool_calls_info) < self.max_tool_calls
+
+__all__ = [
+    'Budget'
+]
@@ -1,11 +1,28 @@
+from __future__ import annotations
+
 from .memory import *
 from ._response import Response
+from .events import TextDelta, ToolCallStart, ToolArgsDelta, ToolChunk, ToolResult, Usage, Done
+from .profiling import _NULL_TURN
+from ._singleflight import SingleFlight
+from .budget import Budget
+from ._ollama import PriorityLimiter, MeteredStream, AsyncMeteredStream, estimate_tokens, estimate_input_tokens, priority_var
 
-from typing import Literal
+from typing import Any, Awaitable, Callable, Literal, TYPE_CHECKING
 from collections import defaultdict
-import json
+from contextlib import contextmanager
+import asyncio
+import threading
+
+from openai import OpenAI, AsyncOpenAI, APITimeoutError
+import httpx
 
-from openai import OpenAI, AsyncOpenAI
+# Raised by the provider calls and async tools when the deadline of a `Budget` passes
+TIMEOUT_ERRORS = (APITimeoutError, httpx.TimeoutException, asyncio.TimeoutError)
+
+if TYPE_CHECKING:
+    from .toolkit.artifacts import ResultGovernor
+    from .profiling import Profiler, TurnProfile
 
 class Chat:
 
@@ -14,308 +31,674 @@ class Chat:
         api_key: str,
         base_url: str,
         model: str,
+        governor: ResultGovernor = None,
+        profiler: Profiler = None,
+        coalesce: bool = False
     ):
+        """
+        Args:
+            governor: If given, large tool results are replaced by a preview before being written to the memory.
+
+            profiler: If given, the turns are profiled: time per provider call, tool and memory handling,
+                stack samples for flamegraphs and a cProfile of each tool.
+
+            coalesce: If True, identical concurrent requests of `ainvoke`/`astream` (same model, messages,
+                tools and temperature) share a single provider call, a stream is replayed to each of them.
+                Every caller gets the usage of the shared call, `single_flight.coalesced` counts the calls saved.
+        """
         self._client = OpenAI(api_key=api_key, base_url=base_url)
         self._async_client = AsyncOpenAI(api_key=api_key, base_url=base_url)
         self.model = model
+        self.governor = governor
+        self.profiler = profiler
+        self.single_flight = SingleFlight() if coalesce else None
 
     def stream(
         self,
         user_prompt: str = None, 
         temperature: float | None = None,
         memory: Memory = None, 
-        tools: list[callable] = []
+        tools: list[callable] = [],
+        on_tool_chunk: Callable[[str, Any], bool | None] = None,
+        budget: Budget = None
+    ):
+        return self._stream(user_prompt, temperature, memory, tools, on_tool_chunk, budget, events=False)
+
+    def stream_events(
+        self,
+        user_prompt: str = None, 
+        temperature: float | None = None,
+        memory: Memory = None, 
+        tools: list[callable] = [],
+        on_tool_chunk: Callable[[str, Any], bool | None] = None,
+        budget: Budget = None
+    ):
+        """
+        Like `stream`, but yields typed events: `TextDelta`, `ToolCallStart`, `ToolArgsDelta`, `ToolChunk`,
+        `ToolResult`, `Usage` after each model call, and `Done` with the final `Response` last.
+        Encode them with `crazyagent.events.sse` to serve them as server-sent events.
+        """
+        return self._stream(user_prompt, temperature, memory, tools, on_tool_chunk, budget, events=True)
+
+    def _stream(
+        self,
+        user_prompt: str,
+        temperature: float | None,
+        memory: Memory,
+        tools: list[callable],
+        on_tool_chunk: Callable[[str, Any], bool | None],
+        budget: Budget,
+        events: bool
     ):
+        """
+        The turn loop of `stream` and `stream_events`. Without `events`, the text and tool chunks are
+        yielded as `Response`s directly and the other events are skipped, so no event is built per chunk.
+        """
         temperature = self.check_temperature(temperature)
-        memory, tool_map, tools_definition = self.prepare(
+        turn, tool_map, tools_definition = self.prepare(
             user_prompt=user_prompt,
             memory=memory,
             tools=tools
         )
+        profile = self.profile_turn()
+        budget = (budget or Budget()).start()
 
         resp = Response()       
         assistant_response: str = ''
         while True:
-            chat_completion_stream = self._client.chat.completions.create(
-                model=self.model,
-                messages=list(memory),
-                tools=tools_definition if tools_definition else None,
-                stream=True,
-                temperature=temperature
-            )
-
-            tools_to_call = defaultdict(dict)
-            now_tool_call_id: str = None
-
-            for chunk in chat_completion_stream:
-                # print(chunk)
-                choice = chunk.choices[0]  
-                finish_reason: Literal['stop', 'tool_calls', None] = choice.finish_reason
-                content: str | None = choice.delta.content  
-                if content == '' and finish_reason not in ['stop', 'tool_calls']: continue
-
-                # Normal conversation termination
-                if finish_reason == 'stop':
-                    memory.update(AIMessage(content=assistant_response))
-                    resp.stop_usage = self.get_stream_usage_when_done(chunk)
-                    yield resp
-                    return
-                # Tool call termination
-                elif finish_reason == 'tool_calls':
-                    for k, v in dict(tools_to_call).items():
-                        tool_call_id: str = k
-                        tool_name: str = v['tool_name']
-                        tool_args: str = v['tool_args']
-                        tool_args_dict: dict = json.loads(v['tool_args'])
+            if (reason := budget.check(resp)) is not None:
+                yield self.done(self.stop_turn(turn, profile, resp, reason, assistant_response), events)
+                return
+            with profile.phase('memory'):
+                messages = list(turn)
+            chat_completion_stream = None
+            # The text of this model call starts here, its usage is known once it finishes
+            call_start = len(assistant_response)
+            usage: dict = None
+            try:
+                with profile.phase('provider'):
+                    chat_completion_stream = self.create_completion(
+                        budget=budget,
+                        model=self.model,
+                        messages=messages,
+                        tools=tools_definition if tools_definition else None,
+                        stream=True,
+                        temperature=temperature
+                    )
 
-                        tool_response: str = self.get_tool_response(
-                            tool_map=tool_map,
-                            tool_name=tool_name,
-                            tool_args=tool_args_dict
-                        )
-                        memory.update(
-                            AICallToolMessage(tool_call_id, tool_name, tool_args), 
-                            ToolMessage(tool_response, tool_call_id)
-                        )
-                        resp.add_tool_call_info(
-                            name=tool_name, 
-                            args=tool_args, 
-                            response=tool_response, 
-                            usage=self.get_stream_usage_when_done(chunk)
-                        )
-                        # This restricts the model to calling only one tool at a time, which has proven to be correct.
-                        # The most stable pattern is: tool call -> chat -> tool call -> chat.
-                        # If multiple tools are called at once, and a tool's arguments depend on the output of a previous tool, it will fail.
-                        break  
+                tools_to_call = defaultdict(dict)
+                now_tool_call_id: str = None
+
+                for chunk in profile.iterate(chat_completion_stream):
+                    if (reason := budget.check_time()) is not None:
+                        usage = self.cut_usage(usage, messages, tools_definition, assistant_response[call_start:])
+                        yield self.done(self.stop_turn(turn, profile, resp, reason, assistant_response, usage), events)
+                        return
+                    # print(chunk)
+                    choice = chunk.choices[0]  
+                    finish_reason: Literal['stop', 'tool_calls', None] = choice.finish_reason
+                    content: str | None = choice.delta.content  
+                    if content == '' and finish_reason not in ['stop', 'tool_calls']: continue
+
+                    # Normal conversation termination
+                    if finish_reason == 'stop':
+                        turn.update(AIMessage(content=assistant_response))
+                        turn.commit()
+                        profile.finish()
+                        resp.stop_usage = self.get_stream_usage_when_done(chunk)
+                        if events:
+                            yield Usage(resp.stop_usage)
+                        yield self.done(resp, events)
+                        return
+                    # Tool call termination
+                    elif finish_reason == 'tool_calls':
+                        usage = self.get_stream_usage_when_done(chunk)
+                        for k, v in dict(tools_to_call).items():
+                            tool_call_id: str = k
+                            tool_name: str = v['tool_name']
+                            tool_args: str = v['tool_args']
+                            tool_call_message = AICallToolMessage(tool_call_id, tool_name, tool_args)
+                            tool_args_dict: dict = tool_call_message.parsed_args
+
+                            if not budget.allows_tool_call(resp):
+                                yield self.done(self.stop_turn(turn, profile, resp, 'max_tool_calls', assistant_response, usage), events)
+                                return
+                            tool = tool_map[tool_name]
+                            if tool._is_stream:
+                                # The chunks are yielded to the caller meanwhile, so stack samples are not attributed to the tool
+                                with profile.tool(tool_name, blocking=False):
+                                    results = tool.stream(**tool_args_dict)
+                                    for tool_chunk in results:
+                                        yield ToolChunk(tool_call_id, tool_name, tool_chunk) if events else Response(tool_chunk={'name': tool_name, 'chunk': tool_chunk})
+                                        if (on_tool_chunk is not None and on_tool_chunk(tool_name, tool_chunk)) or budget.check_time() is not None:
+                                            results.close()
+                                            break
+                                tool_response = self.govern_tool_response(tool_name, results.result)
+                            else:
+                                with profile.tool(tool_name):
+                                    tool_response: str = self.get_tool_response(
+                                        tool_map=tool_map,
+                                        tool_name=tool_name,
+                                        tool_args=tool_args_dict
+                                    )
+                            turn.update(
+                                tool_call_message, 
+                                ToolMessage(tool_response, tool_call_id)
+                            )
+                            resp.add_tool_call_info(
+                                name=tool_name, 
+                                args=tool_args, 
+                                response=tool_response, 
+                                usage=usage
+                            )
+                            if events:
+                                yield ToolResult(tool_call_id, tool_name, tool_response)
+                                yield Usage(usage)
+                            # This restricts the model to calling only one tool at a time, which has proven to be correct.
+                            # The most stable pattern is: tool call -> chat -> tool call -> chat.
+                            # If multiple tools are called at once, and a tool's arguments depend on the output of a previous tool, it will fail.
+                            break  
                 
-                # Handle tool calls in non-termination cases
-                if (tool_calls := choice.delta.tool_calls) is not None:
-                    tool_call = tool_calls[0]
-                    # func_name is a string the first time, and None in subsequent occurrences
-                    func_name = tool_call.function.name
-                    # func_args is an empty string the first time, and a non-empty string in subsequent occurrences
-                    func_args = tool_call.function.arguments
-                    if tool_call.id not in tools_to_call and tool_call.id is not None:
-                        now_tool_call_id = tool_call.id
-                        tools_to_call[now_tool_call_id]['tool_name'] = func_name
-
-                    if not tools_to_call[now_tool_call_id].get('tool_args'):
-                        tools_to_call[now_tool_call_id]['tool_args'] = ''
-                    tools_to_call[now_tool_call_id]['tool_args'] += func_args
-                    continue
-                # Handle content in non-termination cases
-                if content is None: continue
-                else:
-                    assistant_response += content
-                    yield Response(content=content)
+                    # Handle tool calls in non-termination cases
+                    if (tool_calls := choice.delta.tool_calls) is not None:
+                        tool_call = tool_calls[0]
+                        # func_name is a string the first time, and None in subsequent occurrences
+                        func_name = tool_call.function.name
+                        # func_args is an empty string the first time, and a non-empty string in subsequent occurrences
+                        func_args = tool_call.function.arguments
+                        if tool_call.id not in tools_to_call and tool_call.id is not None:
+                            now_tool_call_id = tool_call.id
+                            tools_to_call[now_tool_call_id]['tool_name'] = func_name
+                            if events:
+                                yield ToolCallStart(now_tool_call_id, func_name)
+
+                        if not tools_to_call[now_tool_call_id].get('tool_args'):
+                            tools_to_call[now_tool_call_id]['tool_args'] = ''
+                        tools_to_call[now_tool_call_id]['tool_args'] += func_args
+                        if func_args and events:
+                            yield ToolArgsDelta(now_tool_call_id, func_args)
+                        continue
+                    # Handle content in non-termination cases
+                    if content is None: continue
+                    else:
+                        assistant_response += content
+                        yield TextDelta(content) if events else Response(content=content)
+            except TIMEOUT_ERRORS:
+                if budget.deadline is None:
+                    raise
+                usage = self.cut_usage(usage, messages, tools_definition, assistant_response[call_start:])
+                yield self.done(self.stop_turn(turn, profile, resp, 'timeout', assistant_response, usage), events)
+                return
+            finally:
+                # Also when the caller stops iterating or the task is cancelled, so the connection is released
+                if chat_completion_stream is not None:
+                    chat_completion_stream.close()
 
     def invoke(
         self,
         user_prompt: str,
         temperature: float | None = None,
         memory: Memory = None,
-        tools: list[callable] = []
+        tools: list[callable] = [],
+        on_tool_chunk: Callable[[str, Any], bool | None] = None,
+        budget: Budget = None
     ):
         temperature = self.check_temperature(temperature)
-        memory, tool_map, tools_definition = self.prepare(
+        turn, tool_map, tools_definition = self.prepare(
             user_prompt=user_prompt,
             memory=memory,
             tools=tools
         )
+        profile = self.profile_turn()
+        budget = (budget or Budget()).start()
         resp = Response()
         while True:
-            chat_completion = self._client.chat.completions.create(
-                model=self.model,
-                messages=list(memory),
-                tools=tools_definition if tools_definition else None,
-                temperature=temperature
-            )
-
-            choice = chat_completion.choices[0]
-            finish_reason: Literal['stop', 'tool_calls'] = choice.finish_reason
-            content: str = choice.message.content
-            usage = {
-                'input_tokens': chat_completion.usage.prompt_tokens,
-                'output_tokens': chat_completion.usage.completion_tokens,
-                'total_tokens': chat_completion.usage.total_tokens
-            }
+            if (reason := budget.check(resp)) is not None:
+                return self.stop_turn(turn, profile, resp, reason)
+            # Known once the model call returns
+            usage: dict = None
+            try:
+                with profile.phase('memory'):
+                    messages = list(turn)
+                with profile.phase('provider'):
+                    chat_completion = self.create_completion(
+                        budget=budget,
+                        model=self.model,
+                        messages=messages,
+                        tools=tools_definition if tools_definition else None,
+                        temperature=temperature
+                    )
 
-            if finish_reason == 'stop':
-                memory.update(AIMessage(content))
-                resp.content = content
-                resp.stop_usage = usage
-                return resp
-            elif finish_reason == 'tool_calls':
-                tool_call = choice.message.tool_calls[0]
-
-                tool_call_id: str = tool_call.id
-                tool_name: str = tool_call.function.name
-                tool_args: str = tool_call.function.arguments
-                tool_args_dict: dict = json.loads(tool_args)
-
-                tool_response = self.get_tool_response(
-                    tool_map=tool_map,
-                    tool_name=tool_name,
-                    tool_args=tool_args_dict
-                )
-
-                memory.update(
-                    AICallToolMessage(tool_call_id, tool_name, tool_args),
-                    ToolMessage(content=tool_response, tool_call_id=tool_call_id)
-                )
-                resp.add_tool_call_info(
-                    name=tool_name,
-                    args=tool_args,
-                    response=tool_response,
-                    usage=usage
-                )
-
-    async def astream(
+                choice = chat_completion.choices[0]
+                finish_reason: Literal['stop', 'tool_calls'] = choice.finish_reason
+                content: str = choice.message.content
+                usage = {
+                    'input_tokens': chat_completion.usage.prompt_tokens,
+                    'output_tokens': chat_completion.usage.completion_tokens,
+                    'total_tokens': chat_completion.usage.total_tokens
+                }
+
+                if finish_reason == 'stop':
+                    turn.update(AIMessage(content))
+                    turn.commit()
+                    profile.finish()
+                    resp.content = content
+                    resp.stop_usage = usage
+                    return resp
+                elif finish_reason == 'tool_calls':
+                    tool_call = choice.message.tool_calls[0]
+
+                    tool_call_id: str = tool_call.id
+                    tool_name: str = tool_call.function.name
+                    tool_args: str = tool_call.function.arguments
+                    tool_call_message = AICallToolMessage(tool_call_id, tool_name, tool_args)
+                    tool_args_dict: dict = tool_call_message.parsed_args
+                    if not budget.allows_tool_call(resp):
+                        return self.stop_turn(turn, profile, resp, 'max_tool_calls', usage=usage)
+
+                    with profile.tool(tool_name):
+                        tool_response = self.get_tool_response(
+                            tool_map=tool_map,
+                            tool_name=tool_name,
+                            tool_args=tool_args_dict,
+                            on_tool_chunk=on_tool_chunk,
+                            budget=budget
+                        )
+
+                    turn.update(
+                        tool_call_message,
+                        ToolMessage(content=tool_response, tool_call_id=tool_call_id)
+                    )
+                    resp.add_tool_call_info(
+                        name=tool_name,
+                        args=tool_args,
+                        response=tool_response,
+                        usage=usage
+                    )
+            except TIMEOUT_ERRORS:
+                if budget.deadline is None:
+                    raise
+                return self.stop_turn(turn, profile, resp, 'timeout', usage=self.cut_usage(usage, messages, tools_definition))
+
+    def astream(
+        self,
+        user_prompt: str,
+        temperature: float | None = None,
+        memory: Memory = None,
+        tools: list[callable] = [],
+        on_tool_chunk: Callable[[str, Any], bool | None] = None,
+        budget: Budget = None
+    ):
+        return self._astream(user_prompt, temperature, memory, tools, on_tool_chunk, budget, events=False)
+
+    def astream_events(
         self,
         user_prompt: str,
         temperature: float | None = None,
         memory: Memory = None,
-        tools: list[callable] = []
+        tools: list[callable] = [],
+        on_tool_chunk: Callable[[str, Any], bool | None] = None,
+        budget: Budget = None
     ):
+        """Like `astream`, but yields typed events, see `stream_events`."""
+        return self._astream(user_prompt, temperature, memory, tools, on_tool_chunk, budget, events=True)
+
+    async def _astream(
+        self,
+        user_prompt: str,
+        temperature: float | None,
+        memory: Memory,
+        tools: list[callable],
+        on_tool_chunk: Callable[[str, Any], bool | None],
+        budget: Budget,
+        events: bool
+    ):
+        """The turn loop of `astream` and `astream_events`, see `_stream`."""
         temperature = self.check_temperature(temperature)
-        memory, tool_map, tools_definition = self.prepare(
+        turn, tool_map, tools_definition = self.prepare(
             user_prompt=user_prompt,
             memory=memory,
             tools=tools
         )
+        profile = self.profile_turn()
+        budget = (budget or Budget()).start()
 
         resp = Response()
         assistant_response: str = ''
         while True:
-            chat_completion_stream = await self._async_client.chat.completions.create(
-                model=self.model,
-                messages=list(memory),
-                tools=tools_definition if tools_definition else None,
-                stream=True,
-                temperature=temperature
-            )
-
-            tools_to_call = defaultdict(dict)
-            now_tool_call_id: str = None
-
-            async for chunk in chat_completion_stream:
-                choice = chunk.choices[0]  
-                finish_reason: Literal['stop', 'tool_calls', None] = choice.finish_reason
-                content: str | None = choice.delta.content
-                if content == '' and finish_reason not in ['stop', 'tool_calls']: continue
-
-                # Normal conversation termination
-                if finish_reason == 'stop':
-                    memory.update(AIMessage(content=assistant_response))
-                    resp.stop_usage = self.get_stream_usage_when_done(chunk)
-                    yield resp
-                    return
-                # Tool call termination
-                elif finish_reason == 'tool_calls':
-                    for k, v in dict(tools_to_call).items():
-                        tool_call_id: str = k
-                        tool_name: str = v['tool_name']
-                        tool_args: str = v['tool_args']
-                        tool_args_dict: dict = json.loads(v['tool_args'])
+            if (reason := budget.check(resp)) is not None:
+                yield self.done(self.stop_turn(turn, profile, resp, reason, assistant_response), events)
+                return
+            with profile.phase('memory'):
+                messages = list(turn)
+            chat_completion_stream = None
+            # The text of this model call starts here, its usage is known once it finishes
+            call_start = len(assistant_response)
+            usage: dict = None
+            try:
+                with profile.phase('provider', blocking=False):
+                    chat_completion_stream = await budget.run(self.acreate_completion(
+                        budget=budget,
+                        model=self.model,
+                        messages=messages,
+                        tools=tools_definition if tools_definition else None,
+                        stream=True,
+                        temperature=temperature
+                    ))
 
-                        tool_response: str = await self.get_async_tool_response(
-                            tool_map=tool_map,
-                            tool_name=tool_name,
-                            tool_args=tool_args_dict
-                        )
-                        memory.update(AICallToolMessage(tool_call_id, tool_name, tool_args), ToolMessage(tool_response, tool_call_id))
-                        resp.add_tool_call_info(
-                            name=tool_name, 
-                            args=tool_args, 
-                            response=tool_response, 
-                            usage=self.get_stream_usage_when_done(chunk)
-                        )
-                        # This restricts the model to calling only one tool at a time, which has proven to be correct.
-                        # The most stable pattern is: tool call -> chat -> tool call -> chat.
-                        # If multiple tools are called at once, and a tool's arguments depend on the output of a previous tool, it will fail.
-                        break  
+                tools_to_call = defaultdict(dict)
+                now_tool_call_id: str = None
+
+                async for chunk in profile.aiterate(chat_completion_stream):
+                    if (reason := budget.check_time()) is not None:
+                        usage = self.cut_usage(usage, messages, tools_definition, assistant_response[call_start:])
+                        yield self.done(self.stop_turn(turn, profile, resp, reason, assistant_response, usage), events)
+                        return
+                    choice = chunk.choices[0]  
+                    finish_reason: Literal['stop', 'tool_calls', None] = choice.finish_reason
+                    content: str | None = choice.delta.content
+                    if content == '' and finish_reason not in ['stop', 'tool_calls']: continue
+
+                    # Normal conversation termination
+                    if finish_reason == 'stop':
+                        turn.update(AIMessage(content=assistant_response))
+                        turn.commit()
+                        profile.finish()
+                        resp.stop_usage = self.get_stream_usage_when_done(chunk)
+                        if events:
+                            yield Usage(resp.stop_usage)
+                        yield self.done(resp, events)
+                        return
+                    # Tool call termination
+                    elif finish_reason == 'tool_calls':
+                        usage = self.get_stream_usage_when_done(chunk)
+                        for k, v in dict(tools_to_call).items():
+                            tool_call_id: str = k
+                            tool_name: str = v['tool_name']
+                            tool_args: str = v['tool_args']
+                            tool_call_message = AICallToolMessage(tool_call_id, tool_name, tool_args)
+                            tool_args_dict: dict = tool_call_message.parsed_args
+
+                            if not budget.allows_tool_call(resp):
+                                yield self.done(self.stop_turn(turn, profile, resp, 'max_tool_calls', assistant_response, usage), events)
+                                return
+                            tool = tool_map[tool_name]
+                            if tool._is_stream:
+                                # The chunks are yielded to the caller meanwhile, so stack samples are not attributed to the tool
+                                with profile.tool(tool_name, blocking=False):
+                                    results = tool.stream(**tool_args_dict)
+                                    async for tool_chunk in results:
+                                        yield ToolChunk(tool_call_id, tool_name, tool_chunk) if events else Response(tool_chunk={'name': tool_name, 'chunk': tool_chunk})
+                                        if (on_tool_chunk is not None and on_tool_chunk(tool_name, tool_chunk)) or budget.check_time() is not None:
+                                            await results.aclose()
+                                            break
+                                tool_response = self.govern_tool_response(tool_name, results.result)
+                            else:
+                                with profile.tool(tool_name, blocking=not tool._is_async):
+                                    tool_response: str = await self.arun_tool(
+                                        budget,
+                                        tool,
+                                        self.get_async_tool_response(
+                                            tool_map=tool_map,
+                                            tool_name=tool_name,
+                                            tool_args=tool_args_dict
+                                        )
+                                    )
+                            turn.update(tool_call_message, ToolMessage(tool_response, tool_call_id))
+                            resp.add_tool_call_info(
+                                name=tool_name, 
+                                args=tool_args, 
+                                response=tool_response, 
+                                usage=usage
+                            )
+                            if events:
+                                yield ToolResult(tool_call_id, tool_name, tool_response)
+                                yield Usage(usage)
+                            # This restricts the model to calling only one tool at a time, which has proven to be correct.
+                            # The most stable pattern is: tool call -> chat -> tool call -> chat.
+                            # If multiple tools are called at once, and a tool's arguments depend on the output of a previous tool, it will fail.
+                            break  
                 
-                # Handle tool calls in non-termination cases
-                if (tool_calls := choice.delta.tool_calls) is not None:
-                    tool_call = tool_calls[0]
-                    # func_name is a string the first time, and None in subsequent occurrences
-                    func_name = tool_call.function.name
-                    # func_args is an empty string the first time, and a non-empty string in subsequent occurrences
-                    func_args = tool_call.function.arguments
-                    if tool_call.id not in tools_to_call and tool_call.id is not None:
-                        now_tool_call_id = tool_call.id
-                        tools_to_call[now_tool_call_id]['tool_name'] = func_name
-
-                    if not tools_to_call[now_tool_call_id].get('tool_args'):
-                        tools_to_call[now_tool_call_id]['tool_args'] = ''
-                    tools_to_call[now_tool_call_id]['tool_args'] += func_args
-                    continue
-                # Handle content in non-termination cases
-                if content is None: continue
-                else:
-                    assistant_response += content
-                    yield Response(content=content)
+                    # Handle tool calls in non-termination cases
+                    if (tool_calls := choice.delta.tool_calls) is not None:
+                        tool_call = tool_calls[0]
+                        # func_name is a string the first time, and None in subsequent occurrences
+                        func_name = tool_call.function.name
+                        # func_args is an empty string the first time, and a non-empty string in subsequent occurrences
+                        func_args = tool_call.function.arguments
+                        if tool_call.id not in tools_to_call and tool_call.id is not None:
+                            now_tool_call_id = tool_call.id
+                            tools_to_call[now_tool_call_id]['tool_name'] = func_name
+                            if events:
+                                yield ToolCallStart(now_tool_call_id, func_name)
+
+                        if not tools_to_call[now_tool_call_id].get('tool_args'):
+                            tools_to_call[now_tool_call_id]['tool_args'] = ''
+                        tools_to_call[now_tool_call_id]['tool_args'] += func_args
+                        if func_args and events:
+                            yield ToolArgsDelta(now_tool_call_id, func_args)
+                        continue
+                    # Handle content in non-termination cases
+                    if content is None: continue
+                    else:
+                        assistant_response += content
+                        yield TextDelta(content) if events else Response(content=content)
+            except (*TIMEOUT_ERRORS, asyncio.CancelledError) as e:
+                reason = self.interrupted(e, budget)
+                usage = self.cut_usage(usage, messages, tools_definition, assistant_response[call_start:])
+                yield self.done(self.stop_turn(turn, profile, resp, reason, assistant_response, usage), events)
+                return
+            finally:
+                # Also when the caller stops iterating or the task is cancelled, so the connection is released
+                if chat_completion_stream is not None:
+                    await self.aclose_stream(chat_completion_stream)
 
     async def ainvoke(
         self,
         user_prompt: str,
         temperature: float | None = None,
         memory: Memory = None,
-        tools: list[callable] = []
+        tools: list[callable] = [],
+        on_tool_chunk: Callable[[str, Any], bool | None] = None,
+        budget: Budget = None
     ):
         temperature = self.check_temperature(temperature)
-        memory, tool_map, tools_definition = self.prepare(
+        turn, tool_map, tools_definition = self.prepare(
             user_prompt=user_prompt,
             memory=memory,
             tools=tools
         )
+        profile = self.profile_turn()
+        budget = (budget or Budget()).start()
         resp = Response()
         while True:
-            chat_completion = await self._async_client.chat.completions.create(
-                model=self.model,
-                messages=list(memory),
-                tools=tools_definition if tools_definition else None,
-                temperature=temperature
-            )
-
-            choice = chat_completion.choices[0]
-            finish_reason: Literal['stop', 'tool_calls'] = choice.finish_reason
-            content: str = choice.message.content
-            usage = {
-                'input_tokens': chat_completion.usage.prompt_tokens,
-                'output_tokens': chat_completion.usage.completion_tokens,
-                'total_tokens': chat_completion.usage.total_tokens
-            }
+            if (reason := budget.check(resp)) is not None:
+                return self.stop_turn(turn, profile, resp, reason)
+            # Known once the model call returns
+            usage: dict = None
+            try:
+                with profile.phase('memory'):
+                    messages = list(turn)
+                with profile.phase('provider', blocking=False):
+                    chat_completion = await budget.run(self.acreate_completion(
+                        budget=budget,
+                        model=self.model,
+                        messages=messages,
+                        tools=tools_definition if tools_definition else None,
+                        temperature=temperature
+                    ))
+
+                choice = chat_completion.choices[0]
+                finish_reason: Literal['stop', 'tool_calls'] = choice.finish_reason
+                content: str = choice.message.content
+                usage = {
+                    'input_tokens': chat_completion.usage.prompt_tokens,
+                    'output_tokens': chat_completion.usage.completion_tokens,
+                    'total_tokens': chat_completion.usage.total_tokens
+                }
+
+                if finish_reason == 'stop':
+                    turn.update(AIMessage(content))
+                    turn.commit()
+                    profile.finish()
+                    resp.content = content
+                    resp.stop_usage = usage
+                    return resp
+                elif finish_reason == 'tool_calls':
+                    tool_call = choice.message.tool_calls[0]
+
+                    tool_call_id: str = tool_call.id
+                    tool_name: str = tool_call.function.name
+                    tool_args: str = tool_call.function.arguments
+                    tool_call_message = AICallToolMessage(tool_call_id, tool_name, tool_args)
+                    tool_args_dict: dict = tool_call_message.parsed_args
+                    if not budget.allows_tool_call(resp):
+                        return self.stop_turn(turn, profile, resp, 'max_tool_calls', usage=usage)
+
+                    # Async tools let the event loop run other turns meanwhile
+                    with profile.tool(tool_name, blocking=not tool_map[tool_name]._is_async):
+                        tool_response = await self.arun_tool(
+                            budget,
+                            tool_map[tool_name],
+                            self.get_async_tool_response(
+                                tool_map=tool_map,
+                                tool_name=tool_name,
+                                tool_args=tool_args_dict,
+                                on_tool_chunk=on_tool_chunk,
+                                budget=budget
+                            )
+                        )
+
+                    turn.update(
+                        tool_call_message,
+                        ToolMessage(content=tool_response, tool_call_id=tool_call_id)
+                    )
+                    resp.add_tool_call_info(
+                        name=tool_name,
+                        args=tool_args,
+                        response=tool_response,
+                        usage=usage
+                    )
+            except (*TIMEOUT_ERRORS, asyncio.CancelledError) as e:
+                reason = self.interrupted(e, budget)
+                return self.stop_turn(turn, profile, resp, reason, usage=self.cut_usage(usage, messages, tools_definition))
+
+    @staticmethod
+    def done(resp: Response, events: bool) -> Done | Response:
+        return Done(resp) if events else resp
+
+    @staticmethod
+    def within(client: OpenAI | AsyncOpenAI, budget: Budget | None) -> OpenAI | AsyncOpenAI:
+        """The client bounded by the deadline of the budget."""
+        remaining = budget.remaining() if budget is not None else None
+        if remaining is None:
+            return client
+        # Retrying past the deadline is pointless
+        return client.with_options(timeout=remaining, max_retries=0)
+
+    def create_completion(self, budget: Budget = None, **request):
+        """Send a chat completion request."""
+        return self.within(self._client, budget).chat.completions.create(**request)
+
+    async def acreate_completion(self, budget: Budget = None, **request):
+        """
+        Send a chat completion request, through the single-flight layer if `coalesce` is on.
+        Streams are read within the budget, so a cancel interrupts the wait for the next chunk.
+        """
+        if self.single_flight is None:
+            if request.get('stream'):
+                return self.within_budget(await self.asend_completion(budget, **request), budget)
+            return await self.asend_completion(budget, **request)
+        key = self.single_flight.key(**request)
+        # The shared request has no deadline: the callers have their own, each applies it to its own wait
+        if request.get('stream'):
+            return self.within_budget(self.single_flight.stream(key, lambda: self.asend_completion(None, **request)), budget)
+        return await self.single_flight.call(key, lambda: self.asend_completion(None, **request))
+
+    async def asend_completion(self, budget: Budget = None, **request):
+        """Send one chat completion request to the provider."""
+        return await self.within(self._async_client, budget).chat.completions.create(**request)
+
+    @classmethod
+    async def within_budget(cls, stream, budget: Budget | None):
+        """Iterate a stream, each wait for a chunk interrupted by the deadline or the cancellation of the budget."""
+        try:
+            if budget is None:
+                async for chunk in stream:
+                    yield chunk
+                return
+            while True:
+                try:
+                    chunk = await budget.run(stream.__anext__())
+                except StopAsyncIteration:
+                    return
+                yield chunk
+        finally:
+            await cls.aclose_stream(stream)
+
+    @staticmethod
+    async def aclose_stream(stream) -> None:
+        if hasattr(stream, 'aclose'):
+            # A subscription to a stream shared by coalesced requests, the others keep receiving it
+            await stream.aclose()
+        else:
+            await stream.close()
+
+    def stop_turn(
+        self,
+        turn: Transaction,
+        profile: TurnProfile,
+        resp: Response,
+        reason: str,
+        content: str = '',
+        usage: dict = None
+    ) -> Response:
+        """
+        End a turn cut by its budget. The tool calls which returned and the text received so far are
+        committed, a tool call which did not complete is dropped, so the memory stays consistent.
+        A turn which got neither is rolled back, rather than leaving the prompt unanswered in the memory.
+
+        Args:
+            usage: The usage of the model call which was cut, None if the turn stopped between two calls.
+        """
+        if content:
+            turn.update(AIMessage(content))
+        if content or resp.tool_calls_info:
+            turn.commit()
+        else:
+            turn.rollback()
+        profile.finish()
+        resp.stop_reason = reason
+        resp.stop_usage = usage or {'input_tokens': 0, 'output_tokens': 0, 'total_tokens': 0}
+        return resp
+
+    @staticmethod
+    def cut_usage(usage: dict | None, messages: list, tools_definition: list, output: str = '') -> dict:
+        """
+        The usage of a model call cut by the budget: the one the provider reported if it came,
+        else an estimate from the lengths of the request and of the output received.
+        """
+        if usage is not None:
+            return usage
+        input_tokens = estimate_input_tokens(messages, tools_definition)
+        output_tokens = estimate_tokens(output)
+        return {
+            'input_tokens': input_tokens,
+            'output_tokens': output_tokens,
+            'total_tokens': input_tokens + output_tokens
+        }
 
-            if finish_reason == 'stop':
-                memory.update(AIMessage(content))
-                resp.content = content
-                resp.stop_usage = usage
-                return resp
-            elif finish_reason == 'tool_calls':
-                tool_call = choice.message.tool_calls[0]
-
-                tool_call_id: str = tool_call.id
-                tool_name: str = tool_call.function.name
-                tool_args: str = tool_call.function.arguments
-                tool_args_dict: dict = json.loads(tool_args)
-
-                tool_response = await self.get_async_tool_response(
-                    tool_map=tool_map,
-                    tool_name=tool_name,
-                    tool_args=tool_args_dict
-                )
-
-                memory.update(
-                    AICallToolMessage(tool_call_id, tool_name, tool_args),
-                    ToolMessage(content=tool_response, tool_call_id=tool_call_id)
-                )
-                resp.add_tool_call_info(
-                    name=tool_name,
-                    args=tool_args,
-                    response=tool_response,
-                    usage=usage
-                )
+    @staticmethod
+    def interrupted(error: BaseException, budget: Budget) -> str:
+        """The stop reason of an await interrupted by the budget, re-raises errors which are not its doing."""
+        if isinstance(error, asyncio.CancelledError):
+            if not budget.cancelled:
+                # The task of the caller was cancelled
+                raise error
+            return 'cancelled'
+        if budget.deadline is None:
+            raise error
+        return 'timeout'
 
     def check_tools(self, tools: list[callable]) -> tuple[dict[str, callable], list[dict]]:
         tool_map = {tool.__name__: tool for tool in tools}
@@ -330,30 +713,82 @@ class Chat:
         self, 
         tool_map: dict[str, callable], 
         tool_name: str, 
-        tool_args: dict
-    ) -> dict:
-        tool_response = tool_map[tool_name](**tool_args)
-        return tool_response
+        tool_args: dict,
+        on_tool_chunk: Callable[[str, Any], bool | None] = None,
+        budget: Budget = None
+    ) -> str:
+        tool = tool_map[tool_name]
+        if tool._is_stream:
+            results = tool.stream(**tool_args)
+            for tool_chunk in results:
+                if (on_tool_chunk is not None and on_tool_chunk(tool_name, tool_chunk)) or (
+                    budget is not None and budget.check_time() is not None
+                ):
+                    results.close()
+                    break
+            tool_response = results.result
+        else:
+            tool_response = tool(**tool_args)
+        return self.govern_tool_response(tool_name, tool_response)
     
     async def get_async_tool_response(
         self,
         tool_map: dict[str, callable],
         tool_name: str,
-        tool_args: dict
-    ) -> dict:
+        tool_args: dict,
+        on_tool_chunk: Callable[[str, Any], bool | None] = None,
+        budget: Budget = None
+    ) -> str:
         tool = tool_map[tool_name]
-        if tool._is_async:
+        if tool._is_stream:
+            results = tool.stream(**tool_args)
+            async for tool_chunk in results:
+                if (on_tool_chunk is not None and on_tool_chunk(tool_name, tool_chunk)) or (
+                    budget is not None and budget.check_time() is not None
+                ):
+                    await results.aclose()
+                    break
+            tool_response = results.result
+        elif tool._is_async:
             tool_response = await tool(**tool_args)
         else:
             tool_response = tool(**tool_args)
-        return tool_response
+        return self.govern_tool_response(tool_name, tool_response)
+
+    @staticmethod
+    async def arun_tool(budget: Budget, tool: callable, response: Awaitable[str]) -> str:
+        """
+        Await the response of a tool. Async tools are cancelled at the deadline or by `budget.cancel`;
+        sync tools can't be interrupted, they run right away without suspending the turn, so the
+        profiler keeps the thread to this turn.
+        """
+        if tool._is_async:
+            return await budget.run(response)
+        return await response
+
+    def profile_turn(self) -> TurnProfile:
+        """Start profiling a turn, the hooks do nothing if there is no profiler or the turn is not sampled."""
+        if self.profiler is None:
+            return _NULL_TURN
+        return self.profiler.turn()
+
+    def govern_tool_response(self, tool_name: str, tool_response: str) -> str:
+        """Bound the size of a tool result before it is written to the memory."""
+        if self.governor is None:
+            return tool_response
+        return self.governor.govern(tool_response, tool_name)
 
     def prepare(
         self,
         user_prompt: str = None, 
         memory: Memory = None, 
         tools: list[callable] = []   
-    ) -> tuple[Memory, dict, list]:
+    ) -> tuple[Transaction, dict, list]:
+        """
+        Returns:
+            The transaction of this turn on the memory. Messages of the turn are staged in it and
+            committed together when the turn completes, and dropped if it fails or is abandoned.
+        """
         if (not user_prompt is None) and not isinstance(user_prompt, str):
             raise ValueError('user_prompt must be a string or None')
         if memory:
@@ -361,11 +796,14 @@ class Chat:
                 raise ValueError("memory must be a Memory object")
         else:
             memory = Memory()
+        turn = memory.transaction()
         if user_prompt is not None:
-            memory.update(HumanMessage(content=user_prompt))
+            turn.update(HumanMessage(content=user_prompt))
 
+        if self.governor is not None:
+            tools = [*tools, *self.governor.tools]
         tool_map, tools_definition = self.check_tools(tools)
-        return memory, tool_map, tools_definition
+        return turn, tool_map, tools_definition
     
     def get_stream_usage_when_done(self, chunk) -> dict:
         # The APIs of kimi and deepseek only differ in the stream method: kimi's usage is in choice, while deepseek's usage is in chunk.
@@ -375,12 +813,14 @@ class Chat:
             case 'kimi':
                 usage: dict = chunk.choices[0].usage
             case 'ollama':
-                # ollama does not return usage information in the stream response.
-                return {
-                    'input_tokens': 0,
-                    'output_tokens': 0,
-                    'total_tokens': 0
-                }
+                # ollama does not return usage information in the stream response, the streams of `Ollama` put an estimate
+                if chunk.usage is None:
+                    return {
+                        'input_tokens': 0,
+                        'output_tokens': 0,
+                        'total_tokens': 0
+                    }
+                usage = dict(chunk.usage)
         return {
             'input_tokens': usage['prompt_tokens'],
             'output_tokens': usage['completion_tokens'],
@@ -416,9 +856,10 @@ class CloseAI(Chat):
         self,
         api_key: str,
         model: str = 'gpt-4o-mini',
-        base_url: str = 'https://api.openai.com/v1'
+        base_url: str = 'https://api.openai.com/v1',
+        **kwargs
     ):
-        super().__init__(api_key, base_url, model)
+        super().__init__(api_key, base_url, model, **kwargs)
         self.name = 'openai'
 
 class Deepseek(Chat):
@@ -428,8 +869,9 @@ class Deepseek(Chat):
         api_key: str,
         model: str = 'deepseek-chat',
         base_url: str = 'https://api.deepseek.com',
+        **kwargs
     ):
-        super().__init__(api_key, base_url, model)
+        super().__init__(api_key, base_url, model, **kwargs)
         self.name = 'deepseek'
 
 class Moonshot(Chat):
@@ -438,9 +880,10 @@ class Moonshot(Chat):
         self, 
         api_key: str, 
         model = 'moonshot-v1-8k', 
-        base_url = 'https://api.moonshot.cn/v1'
+        base_url = 'https://api.moonshot.cn/v1',
+        **kwargs
     ):
-        super().__init__(api_key, base_url, model)
+        super().__init__(api_key, base_url, model, **kwargs)
         self.name = 'kimi'
 
 class Ollama(Chat):
@@ -449,7 +892,138 @@ class Ollama(Chat):
         self,
         model: str,
         base_url: str = 'http://localhost:11434/v1/',
-        api_key: str = 'ollama'
+        api_key: str = 'ollama',
+        max_concurrency: int = None,
+        keep_alive: str | int = None,
+        preload: bool = False,
+        keep_warm: float = None,
+        **kwargs
     ):
-        super().__init__(api_key, base_url, model)
-        self.name = 'ollama'
\ No newline at end of file
+        """
+        Args:
+            max_concurrency: The number of requests sent to the server at once, set it to the `OLLAMA_NUM_PARALLEL`
+                of the server. The other requests wait in this client, by priority (see `priority`) then in order
+                of arrival, and `metrics()` shows the queue. Waiting counts against the deadline of a `Budget`.
+
+            keep_alive: How long the server keeps the model loaded after a preload or a keep-warm ping,
+                e.g. '30m', or -1 for ever. Requests of the OpenAI-compatible API use the `OLLAMA_KEEP_ALIVE` of the server.
+
+            preload: Load the model now, so the first request doesn't wait for it.
+
+            keep_warm: Ping the model every `keep_warm` seconds while no request runs, so it is not unloaded
+                when idle. Stop it with `close()`.
+
+        The server sends no usage in streams, it is estimated from the lengths of the messages and of the output
+        (about one token per CJK character and per four other characters), so budgets and metrics still work.
+        """
+        super().__init__(api_key, base_url, model, **kwargs)
+        self.name = 'ollama'
+        # The native API of the server, for loading models
+        self.host = base_url.rstrip('/').removesuffix('/v1')
+        self.keep_alive = keep_alive
+        self.limiter = PriorityLimiter(max_concurrency)
+        self.keep_warm_failures = 0
+        self._closed = threading.Event()
+        if preload:
+            self.preload()
+        if keep_warm is not None:
+            threading.Thread(target=self._keep_warm, args=(keep_warm,), name='crazyagent-ollama-keep-warm', daemon=True).start()
+
+    @staticmethod
+    @contextmanager
+    def priority(value: int):
+        """
+        Requests sent inside the block go before the waiting ones with a lower priority (0 by default).
+        Iterate streams inside the block too, e.g.:
+            with Ollama.priority(10):
+                async for response in llm.astream(prompt, memory=memory):
+                    ...
+        """
+        token = priority_var.set(value)
+        try:
+            yield
+        finally:
+            priority_var.reset(token)
+
+    def _load_request(self) -> dict:
+        # A generate request without prompt only loads the model
+        request = {'model': self.model, 'stream': False}
+        if self.keep_alive is not None:
+            request['keep_alive'] = self.keep_alive
+        return request
+
+    def preload(self) -> None:
+        """Load the model into the memory of the server, and keep it for `keep_alive`."""
+        httpx.post(f'{self.host}/api/generate', json=self._load_request(), timeout=600).raise_for_status()
+
+    async def apreload(self) -> None:
+        async with httpx.AsyncClient(timeout=600) as client:
+            (await client.post(f'{self.host}/api/generate', json=self._load_request())).raise_for_status()
+
+    def _keep_warm(self, interval: float) -> None:
+        while not self._closed.wait(interval):
+            # A running request keeps the model loaded anyway
+            if self.limiter.active:
+                continue
+            try:
+                self.preload()
+            except httpx.HTTPError:
+                # e.g. the server restarts, try again at the next interval
+                self.keep_warm_failures += 1
+
+    def close(self) -> None:
+        """Stop the keep-warm pings."""
+        self._closed.set()
+
+    def metrics(self) -> dict:
+        """
+        The state of the request queue, e.g.:
+            {
+                'max_concurrency': 4, 'active': 4, 'waiting': 7, 'served': 1250,
+                'wait_time': 312.5, 'max_wait': 9.8, 'keep_warm_failures': 0
+            }
+        """
+        return {
+            'max_concurrency': self.limiter.limit,
+            'active': self.limiter.active,
+            'waiting': self.limiter.waiting,
+            'served': self.limiter.served,
+            'wait_time': self.limiter.wait_time,
+            'max_wait': self.limiter.max_wait,
+            'keep_warm_failures': self.keep_warm_failures
+        }
+
+    def _prepare_request(self, request: dict) -> None:
+        """Ask for the usage of streams, for servers which support it."""
+        request['stream_options'] = {'include_usage': True}
+
+    def create_completion(self, budget: Budget = None, **request):
+        """Send a chat completion request once a slot of the server is free, a stream holds it until it finishes."""
+        stream = request.get('stream')
+        if stream:
+            self._prepare_request(request)
+        self.limiter.acquire(priority_var.get(), budget.remaining() if budget is not None else None)
+        try:
+            completion = super().create_completion(budget, **request)
+        except BaseException:
+            self.limiter.release()
+            raise
+        if not stream:
+            self.limiter.release()
+            return completion
+        return MeteredStream(completion, self.limiter.release, request['messages'], request.get('tools'))
+
+    async def asend_completion(self, budget: Budget = None, **request):
+        stream = request.get('stream')
+        if stream:
+            self._prepare_request(request)
+        await self.limiter.aacquire(priority_var.get(), budget.remaining() if budget is not None else None)
+        try:
+            completion = await super().asend_completion(budget, **request)
+        except BaseException:
+            self.limiter.release()
+            raise
+        if not stream:
+            self.limiter.release()
+            return completion
+        return AsyncMeteredStream(completion, self.limiter.release, request['messages'], request.get('tools'))
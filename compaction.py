@@ -0,0 +1,129 @@
+from __future__ import annotations
+
+from .memory import (
+    Memory,
+    Message,
+    SystemMessage,
+    HumanMessage,
+    AIMessage,
+    AICallToolMessage,
+    ToolMessage
+)
+
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import TYPE_CHECKING
+import logging
+import threading
+
+if TYPE_CHECKING:
+    from .chat import Chat
+
+SUMMARY_PROMPT = """\
+You maintain a rolling summary of a conversation between a user and an AI assistant.
+Merge the new messages into the existing summary. Keep every fact that may matter later:
+names, preferences, decisions, numbers, dates and results returned by tools.
+Write in the language of the conversation, as a concise list of facts. Output the summary only.\
+"""
+
+# Tool outputs can be huge, only the head of them is worth summarizing.
+MAX_TOOL_CONTENT = 2000
+
+logger = logging.getLogger(__name__)
+
+def format_message(m: Message) -> str:
+    """One-line plain text form of a message, for prompts and indexes."""
+    if isinstance(m, HumanMessage):
+        return f'user: {m.content}'
+    elif isinstance(m, AIMessage):
+        return f'assistant: {m.content}'
+    elif isinstance(m, AICallToolMessage):
+        return f'assistant called tool: {m.tool_name}({m.tool_args})'
+    elif isinstance(m, ToolMessage):
+        return f'tool: {m.content[:MAX_TOOL_CONTENT]}'
+    return f'{m.role}: {m.content}'
+
+class Summarizer:
+
+    def __init__(
+        self,
+        llm: Chat,
+        prompt: str = SUMMARY_PROMPT,
+        max_workers: int = 1
+    ):
+        """
+        Condense the messages evicted from the `max_turns` window of a `Memory`
+        into a rolling summary, in background threads.
+
+        Args:
+            llm: The chat model used to write summaries, usually a cheaper one, e.g. `Ollama`.
+
+            prompt: The system prompt of the summarization request.
+
+            max_workers: The number of background threads. A single summarizer can be shared by many memories.
+        """
+        self.llm = llm
+        self.prompt = prompt
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='crazyagent-summarizer')
+        self._lock = threading.Lock()
+        # id(memory) -> the in-flight summarization job of that memory
+        self._futures: dict[int, Future] = {}
+
+    def submit(self, memory: Memory, upto: int) -> None:
+        """
+        Schedule the summarization of `memory`'s messages in [already summarized, upto).
+
+        Returns immediately. At most one job runs per memory; messages evicted in the meantime
+        are picked up when it finishes, so each message is summarized exactly once.
+        """
+        with self._lock:
+            future = self._futures.get(id(memory))
+            if future is not None and not future.done():
+                return
+            # Read after the check: once the previous job is done, its summary is written
+            summary, summarized = memory._summary
+            if upto <= summarized:
+                return
+            messages = memory._messages[summarized:upto]
+            future = self._executor.submit(self._summarize, memory, summary, messages, upto)
+            self._futures[id(memory)] = future
+        # Outside the lock: if the job is already finished, the callback runs right here and takes it
+        future.add_done_callback(lambda f: self._done(memory, f))
+
+    def wait(self, memory: Memory, timeout: float | None = None) -> None:
+        """Block until the in-flight summarization job of `memory` (if any) is finished."""
+        with self._lock:
+            future = self._futures.get(id(memory))
+        if future is not None:
+            future.result(timeout=timeout)
+
+    def shutdown(self, wait: bool = True) -> None:
+        self._executor.shutdown(wait=wait)
+
+    def _done(self, memory: Memory, future: Future) -> None:
+        with self._lock:
+            if self._futures.get(id(memory)) is future:
+                del self._futures[id(memory)]
+        if future.cancelled():
+            return
+        if (error := future.exception()) is not None:
+            # Not retried right away, the next evicted messages will submit it again
+            logger.error('Summarization of the evicted messages failed', exc_info=error)
+            return
+        # Catch up with the messages evicted while the job was running
+        memory._summarize_evicted()
+
+    def _summarize(self, memory: Memory, summary: str, messages: list[Message], upto: int) -> None:
+        transcript = '\n'.join(format_message(m) for m in messages)
+        if summary:
+            user_prompt = f'# Existing summary\n{summary}\n\n# New messages\n{transcript}'
+        else:
+            user_prompt = f'# New messages\n{transcript}'
+        request_memory = Memory(max_turns=1)
+        request_memory.system_message = SystemMessage(self.prompt)
+        response = self.llm.invoke(user_prompt, memory=request_memory)
+        # A single assignment, so readers on other threads never see a torn state
+        memory._summary = (response.content.strip(), upto)
+
+__all__ = [
+    'Summarizer'
+]
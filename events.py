@@ -0,0 +1,280 @@
+from __future__ import annotations
+
+from . import _fastjson
+from ._response import Response
+
+from typing import AsyncIterable, AsyncIterator, Iterable, Iterator, Literal
+import asyncio
+
+class Event:
+    """An event of `Chat.stream_events` / `Chat.astream_events`."""
+
+    __slots__ = ('_sse',)
+
+    # The 'event:' field of the server-sent event
+    type: str = ''
+
+    def to_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def _sse_data(self) -> bytes:
+        return _fastjson.dumpb(self.to_dict())
+
+    def sse(self) -> bytes:
+        """The event encoded as a server-sent event, encoded once however many clients it is sent to."""
+        try:
+            return self._sse
+        except AttributeError:
+            self._sse = b'event: ' + self.type.encode() + b'\ndata: ' + self._sse_data() + b'\n\n'
+            return self._sse
+
+    def __repr__(self) -> str:
+        return f'{type(self).__name__}({", ".join(f"{k}={v!r}" for k, v in self.to_dict().items())})'
+
+class TextDelta(Event):
+
+    __slots__ = ('content',)
+    type = 'text'
+
+    def __init__(self, content: str):
+        self.content = content
+
+    def _sse_data(self) -> bytes:
+        # The most frequent event, only the string is encoded
+        return b'{"content":' + _fastjson.dumpb(self.content) + b'}'
+
+class ToolCallStart(Event):
+
+    __slots__ = ('id', 'name')
+    type = 'tool_call'
+
+    def __init__(self, id: str, name: str):
+        self.id = id
+        self.name = name
+
+class ToolArgsDelta(Event):
+
+    __slots__ = ('id', 'delta')
+    type = 'tool_args'
+
+    def __init__(self, id: str, delta: str):
+        self.id = id
+        self.delta = delta
+
+class ToolChunk(Event):
+    """A partial result of a generator tool."""
+
+    __slots__ = ('id', 'name', 'chunk')
+    type = 'tool_chunk'
+
+    def __init__(self, id: str, name: str, chunk):
+        self.id = id
+        self.name = name
+        self.chunk = chunk
+
+class ToolResult(Event):
+
+    __slots__ = ('id', 'name', 'content')
+    type = 'tool_result'
+
+    def __init__(self, id: str, name: str, content: str):
+        self.id = id
+        self.name = name
+        self.content = content
+
+class Usage(Event):
+    """The token usage of one completion, sent after each model call of the turn."""
+
+    __slots__ = ('usage',)
+    type = 'usage'
+
+    def __init__(self, usage: dict):
+        self.usage = usage
+
+class Done(Event):
+    """The last event of a turn, `response` is what `stream` yields last."""
+
+    __slots__ = ('response',)
+    type = 'done'
+
+    def __init__(self, response: Response):
+        self.response = response
+
+    def to_dict(self) -> dict:
+        return {
+            'stop_usage': self.response.stop_usage,
+            'total_tokens': self.response.total_tokens,
+            'tool_calls': len(self.response.tool_calls_info),
+            'stop_reason': self.response.stop_reason
+        }
+
+def sse(events: Iterable[Event]) -> Iterator[bytes]:
+    """Encode the events as server-sent events, e.g. to return a streaming HTTP response."""
+    for event in events:
+        yield event.sse()
+
+async def asse(events: AsyncIterable[Event]) -> AsyncIterator[bytes]:
+    async for event in events:
+        yield event.sse()
+
+class SlowConsumerError(Exception):
+    """Raised to a subscriber dropped because it did not keep up with the events."""
+
+class BroadcastCancelledError(Exception):
+    """Raised to the subscribers when the broadcast is cancelled before the turn completes."""
+
+_END = object()
+# Wakes up a subscriber waiting on an empty queue once the broadcast ended
+_WAKE = object()
+
+class Subscriber:
+
+    def __init__(self, maxsize: int, encode: bool):
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize)
+        self._encode = encode
+        self.dropped = False
+        self.closed = False
+        # _END when the source is exhausted, or the error to raise
+        self._end = None
+
+    def __aiter__(self) -> Subscriber:
+        return self
+
+    async def __anext__(self) -> Event | bytes:
+        if self.dropped:
+            raise SlowConsumerError('Subscriber dropped for not keeping up with the events')
+        if self.closed or (self._end is not None and self._queue.empty()):
+            return self._finish()
+        event = await self._queue.get()
+        if event is _WAKE:
+            return self._finish()
+        return event.sse() if self._encode else event
+
+    def _finish(self):
+        if self._end is None or self._end is _END or self.closed:
+            raise StopAsyncIteration
+        # The source failed or the broadcast was cancelled
+        raise self._end
+
+    def close(self) -> None:
+        """
+        Unsubscribe, e.g. when the client disconnects. The broadcast stops sending to this subscriber,
+        and a send waiting for room in its queue goes on.
+        """
+        self.closed = True
+        while not self._queue.empty():
+            self._queue.get_nowait()
+
+    async def __aenter__(self) -> Subscriber:
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        self.close()
+
+class EventBroadcast:
+
+    def __init__(
+        self,
+        events: AsyncIterable[Event],
+        maxsize: int = 64,
+        on_slow: Literal['wait', 'drop'] = 'wait'
+    ):
+        """
+        Fan the events of one turn out to many consumers, each through a bounded queue.
+
+        Args:
+            events: The source, e.g. `llm.astream_events(...)`.
+
+            maxsize: The number of events buffered per subscriber.
+
+            on_slow: What to do when the queue of a subscriber is full.
+                'wait': pause the source until the subscriber catches up. The provider stream is not read
+                    meanwhile, so backpressure reaches the provider, and the slowest subscriber sets the pace.
+                    Close the subscribers of disconnected clients, or they stall the others.
+                'drop': drop the subscriber, its iteration raises `SlowConsumerError`, the others go on.
+        """
+        if on_slow not in ('wait', 'drop'):
+            raise ValueError("on_slow must be 'wait' or 'drop'")
+        self.events = events
+        self.maxsize = maxsize
+        self.on_slow = on_slow
+        self._subscribers: list[Subscriber] = []
+
+    def subscribe(self, sse: bool = False) -> Subscriber:
+        """
+        Args:
+            sse: Receive the events as server-sent-event bytes, encoded once for all subscribers.
+
+        Subscribers only receive the events broadcast after they subscribed. Use it as an async
+        context manager, or call `unsubscribe`, so it is removed when the client goes away, e.g.:
+            async with broadcast.subscribe(sse=True) as subscriber:
+                async for data in subscriber:
+                    ...
+        """
+        subscriber = Subscriber(self.maxsize, sse)
+        self._subscribers.append(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber) -> None:
+        subscriber.close()
+
+    async def _put(self, subscriber: Subscriber, event) -> None:
+        if self.on_slow == 'wait':
+            await subscriber._queue.put(event)
+            if subscriber.closed:
+                # Closed while the put was waiting, which emptied the queue to let it through
+                subscriber._queue.get_nowait()
+            return
+        if subscriber._queue.full():
+            # Give the subscribers which are ready a chance to catch up before giving up on this one
+            await asyncio.sleep(0)
+            if subscriber._queue.full():
+                subscriber.dropped = True
+                return
+        subscriber._queue.put_nowait(event)
+
+    async def run(self) -> None:
+        """
+        Pump the source into the subscribers until it is exhausted, e.g. in `asyncio.create_task`.
+        If the source fails, the error is raised here and to every subscriber; if this is cancelled,
+        the subscribers get a `BroadcastCancelledError`.
+        """
+        end = _END
+        try:
+            async for event in self.events:
+                for subscriber in self._subscribers:
+                    if not (subscriber.dropped or subscriber.closed):
+                        await self._put(subscriber, event)
+                self._subscribers = [s for s in self._subscribers if not (s.dropped or s.closed)]
+        except Exception as e:
+            end = e
+            raise
+        except BaseException:
+            end = BroadcastCancelledError('The broadcast was cancelled before the turn completed')
+            raise
+        finally:
+            if hasattr(self.events, 'aclose'):
+                # Release the provider stream when the broadcast stops early
+                await self.events.aclose()
+            for subscriber in self._subscribers:
+                # Never waits: a subscriber with a full queue finds the end once it has drained it
+                subscriber._end = end
+                if not subscriber._queue.full():
+                    subscriber._queue.put_nowait(_WAKE)
+
+__all__ = [
+    'Event',
+    'TextDelta',
+    'ToolCallStart',
+    'ToolArgsDelta',
+    'ToolChunk',
+    'ToolResult',
+    'Usage',
+    'Done',
+    'sse',
+    'asse',
+    'SlowConsumerError',
+    'BroadcastCancelledError',
+    'Subscriber',
+    'EventBroadcast'
+]
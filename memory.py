@@ -1,19 +1,39 @@
 from __future__ import annotations
 
 from .utils import CS
+from . import _fastjson
 
 from abc import ABC, abstractmethod
-import json
+from typing import TYPE_CHECKING, Callable, Iterable, TextIO
+from collections import OrderedDict
+import asyncio
+import bisect
+import copy
+import functools
+import io
+import itertools
+import re
+import string
+import unicodedata
 
-from tabulate import tabulate
 from typeguard import typechecked
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+if TYPE_CHECKING:
+    from .compaction import Summarizer
+
 # When using list[str] as a type annotation, typeguard behaves as follows:
 # For example, print(x([dict(), 1, 'abc']))
 # The list must contain at least one element of type str.
 # typeguard performs a "most permissive match" check; if it finds at least one str, it considers this a "partially matching" case.
 
 MAXCOLWIDTH = 100
+# Longer contents are cut when rendering a memory as a table
+MAXCONTENT = 1000
 
 class Message(ABC):
 
@@ -36,6 +56,95 @@ class SystemMessage(Message):
         self.content = self.content.format(**kwargs)
         return self
 
+_formatter = string.Formatter()
+_ROOT_NAME = re.compile(r'[^.\[]*')
+
+def _root_name(field: str) -> str:
+    """The name of the keyword argument a replacement field reads, e.g. 'user' for 'user.name'."""
+    name = _ROOT_NAME.match(field).group()
+    if name == '' or name[0].isdigit():
+        raise ValueError(f'Positional field {{{field}}} in template, name it')
+    return name
+# Immutable values, whose rendering cannot change once cached
+_CACHEABLE = frozenset((str, int, float, bool))
+
+class PromptTemplate:
+
+    def __init__(self, template: str, maxsize: int = 128):
+        """
+        A system prompt with `{name}` placeholders (the syntax of `str.format`), parsed once.
+        Rendering joins the precomputed segments without changing the template, and the results are
+        cached per set of values when they are all strings or numbers, so the sessions rendered with
+        the same values share one string.
+
+        e.g.:
+            lover = PromptTemplate(LOVER + '用户的名字是{name}。')
+            memory = Memory(system_message=lover.message(name='小明'))
+
+        Args:
+            template: The prompt, literal braces are written `{{` and `}}`.
+
+            maxsize: The number of rendered prompts kept.
+        """
+        self.template = template
+        self.maxsize = maxsize
+        # Literal text, with None where a field goes
+        self._segments: list[str | None] = []
+        # (index in _segments, field name, simple name, conversion, format spec, spec has fields)
+        self._fields: list[tuple] = []
+        names = {}
+        for literal, field, spec, conversion in _formatter.parse(template):
+            if literal:
+                self._segments.append(literal)
+            if field is None:
+                continue
+            names[_root_name(field)] = None
+            self._fields.append((len(self._segments), field, field.isidentifier(), conversion, spec, '{' in spec))
+            self._segments.append(None)
+            for nested in re.findall(r'{([^{}:!]*)', spec):
+                names[_root_name(nested)] = None
+        # The values a rendering depends on, the other keyword arguments are ignored like `str.format` does
+        self.names = tuple(names)
+        self._cache: OrderedDict[tuple, str] = OrderedDict()
+
+    def render(self, **kwargs) -> str:
+        # The type is part of the key: 1, 1.0 and True are equal but don't render the same
+        key = tuple((type(v := kwargs[name]), v) for name in self.names)
+        if not all(t in _CACHEABLE for t, _ in key):
+            # Other objects may render differently once changed, e.g. a list or a user profile
+            return self._render(kwargs)
+        text = self._cache.get(key)
+        if text is None:
+            text = self._render(kwargs)
+            self._cache[key] = text
+            if len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+        else:
+            try:
+                self._cache.move_to_end(key)
+            except KeyError:
+                # Evicted by another thread in the meantime
+                pass
+        return text
+
+    def _render(self, kwargs: dict) -> str:
+        parts = self._segments.copy()
+        for i, field, simple, conversion, spec, nested in self._fields:
+            value = kwargs[field] if simple else _formatter.get_field(field, (), kwargs)[0]
+            if conversion:
+                value = _formatter.convert_field(value, conversion)
+            if nested:
+                spec = spec.format(**kwargs)
+            parts[i] = format(value, spec)
+        return ''.join(parts)
+
+    def message(self, **kwargs) -> SystemMessage:
+        """A new `SystemMessage` of the rendered prompt, its content shared with the other renderings with the same values."""
+        return SystemMessage(self.render(**kwargs))
+
+    def cache_clear(self) -> None:
+        self._cache.clear()
+
 @typechecked
 class HumanMessage(Message):
 
@@ -67,6 +176,14 @@ class AICallToolMessage(Message):
         self.tool_call_id = tool_call_id
         self.tool_name = tool_name
         self.tool_args = tool_args
+        self._parsed_args = None
+
+    @property
+    def parsed_args(self) -> dict:
+        """The tool arguments, decoded once and cached."""
+        if self._parsed_args is None:
+            self._parsed_args = _fastjson.loads(self.tool_args)
+        return self._parsed_args
 
     def __iter__(self):
         yield 'role', self.role
@@ -97,12 +214,325 @@ class ToolMessage(Message):
         yield 'content', self.content
         yield 'tool_call_id', self.tool_call_id
 
+def _truncate(content: str | None, max_content: int | None) -> str:
+    content = content or ''
+    if max_content is not None and len(content) > max_content:
+        return content[:max_content] + f' ...({len(content) - max_content} more characters)'
+    return content
+
+def _format_tool_call(m: AICallToolMessage, max_content: int | None) -> str:
+    # Only parse arguments short enough to be shown whole
+    if max_content is not None and len(m.tool_args) > max_content:
+        return f'{m.tool_name}({_truncate(m.tool_args, max_content)})'
+    try:
+        tool_args = m.parsed_args
+        formatted_args = ', '.join(
+            f'{k}="{v}"' if isinstance(v, str) else f'{k}={v}'
+            for k, v in tool_args.items()
+        )
+        return f"{m.tool_name}({formatted_args})"
+    except:
+        return f"{m.tool_name}(???)"
+
+@functools.lru_cache(maxsize=4096)
+def _char_width(c: str) -> int:
+    return 2 if unicodedata.east_asian_width(c) in 'WF' else 1
+
+def _wrap(content: str, width: int) -> list[tuple[str, int]]:
+    """
+    Split content into lines of at most `width` display columns (CJK characters take two).
+
+    Returns:
+        The lines and their display widths.
+    """
+    lines = []
+    for paragraph in content.replace('\t', '    ').split('\n'):
+        if paragraph.isascii():
+            # One column per character, cut by slicing
+            lines.extend([(paragraph[i:i + width], min(width, len(paragraph) - i)) for i in range(0, len(paragraph), width)] or [('', 0)])
+            continue
+        # Cut where the running width passes each multiple of the line width
+        ends = list(itertools.accumulate(map(_char_width, paragraph)))
+        start, offset = 0, 0
+        while start < len(paragraph):
+            stop = bisect.bisect_right(ends, offset + width, start)
+            lines.append((paragraph[start:stop], ends[stop - 1] - offset))
+            start, offset = stop, ends[stop - 1]
+    return lines
+
+def _wrapped_width(content: str, width: int) -> int:
+    """The width of the widest line of `_wrap(content, width)`."""
+    if content.isascii() and '\n' not in content and '\t' not in content:
+        return min(len(content), width)
+    return max(w for _, w in _wrap(content, width))
+
+def _write_table(rows: Callable[[], Iterable[tuple[str, str, callable]]], file: TextIO, plain: bool) -> None:
+    """
+    Write rows of (role, content, color) as a grid, one row at a time. `rows` is called twice:
+    once to measure the columns, then to wrap and write each row, so only one row is held at a time.
+    """
+    role_width, content_width = len('Role'), len('Content')
+    for role, content, _ in rows():
+        role_width = max(role_width, len(role))
+        content_width = max(content_width, _wrapped_width(content, MAXCOLWIDTH))
+    border = f"+{'-' * (role_width + 2)}+{'-' * (content_width + 2)}+\n"
+    file.write(border)
+    file.write(f"| {'Role'.ljust(role_width)} | {'Content'.ljust(content_width)} |\n")
+    file.write(border.replace('-', '='))
+    for role, content, color in rows():
+        if plain:
+            color = str
+        for i, (line, line_width) in enumerate(_wrap(content, MAXCOLWIDTH)):
+            cell_role = (role if i == 0 else '').ljust(role_width)
+            padding = ' ' * (content_width - line_width)
+            file.write(f'| {color(cell_role) if i == 0 else cell_role} | {color(line)}{padding} |\n')
+        file.write(border)
+
+class _Segment:
+    """An immutable run of messages, chained to the runs before it."""
+
+    __slots__ = (
+        'parent',
+        'messages',
+        'length'
+    )
+
+    def __init__(self, parent: _Segment | None, messages: tuple[Message, ...]):
+        self.parent = parent
+        self.messages = messages
+        # Number of messages from the root up to and including this segment
+        self.length = (parent.length if parent else 0) + len(messages)
+
+class _MessageLog:
+    """
+    A list of messages made of a sealed, shared prefix (a chain of immutable segments)
+    and a private tail. Forking seals the tail once, so both branches share all the
+    existing messages and only own what they append afterwards.
+    """
+
+    __slots__ = (
+        '_head',
+        '_tail'
+    )
+
+    def __init__(self, head: _Segment = None, tail: list[Message] = None):
+        self._head = head
+        self._tail = tail if tail is not None else []
+
+    def __len__(self) -> int:
+        return (self._head.length if self._head else 0) + len(self._tail)
+
+    def __reduce__(self):
+        # Pickle and deepcopy a flat list, a long chain of segments would hit the recursion limit
+        return (_MessageLog, (None, list(self)))
+
+    def append(self, m: Message) -> None:
+        self._tail.append(m)
+
+    def extend(self, messages) -> None:
+        self._tail.extend(messages)
+
+    def pop(self) -> Message:
+        if self._tail:
+            return self._tail.pop()
+        if self._head is None:
+            raise IndexError('pop from empty memory')
+        # Copy the last segment without its last message, the shared one stays untouched
+        head = self._head
+        *rest, last = head.messages
+        self._head = _Segment(head.parent, tuple(rest)) if rest else head.parent
+        return last
+
+    def fork(self) -> _MessageLog:
+        if self._tail:
+            self._head = _Segment(self._head, tuple(self._tail))
+            self._tail = []
+        return _MessageLog(self._head)
+
+    def _segments(self) -> list[_Segment]:
+        segments = []
+        segment = self._head
+        while segment is not None:
+            segments.append(segment)
+            segment = segment.parent
+        segments.reverse()
+        return segments
+
+    def __iter__(self):
+        if self._head is None:
+            # Nothing shared, the common case
+            return iter(self._tail)
+        return itertools.chain(*[segment.messages for segment in self._segments()], self._tail)
+
+    def __getitem__(self, index):
+        if self._head is None:
+            return self._tail[index]
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                return list(self)[index]
+            return self._range(start, stop)
+        n = len(self)
+        if index < 0:
+            index += n
+        if not 0 <= index < n:
+            raise IndexError('memory index out of range')
+        return self._range(index, index + 1)[0]
+
+    def _range(self, start: int, stop: int) -> list[Message]:
+        """Messages in [start, stop), walking back from the end since recent ones are read the most."""
+        if stop <= start:
+            return []
+        offset = self._head.length if self._head else 0
+        if start >= offset:
+            # Only recent messages, e.g. the `max_turns` window
+            return self._tail[start - offset:stop - offset]
+        chunks = [self._tail[max(start - offset, 0):max(stop - offset, 0)]]
+        segment = self._head
+        while segment is not None and segment.length > start:
+            seg_start = segment.length - len(segment.messages)
+            if seg_start < stop:
+                chunks.append(segment.messages[max(start - seg_start, 0):stop - seg_start])
+            segment = segment.parent
+        r = []
+        for chunk in reversed(chunks):
+            r.extend(chunk)
+        return r
+
+# Version of the Memory.dumps() format, bump it on incompatible changes
+FORMAT_VERSION = 1
+
+def _encode_message(m: Message) -> list:
+    if isinstance(m, HumanMessage):
+        return ['u', m.content]
+    elif isinstance(m, AIMessage):
+        return ['a', m.content]
+    elif isinstance(m, AICallToolMessage):
+        return ['c', m.tool_call_id, m.tool_name, m.tool_args]
+    elif isinstance(m, ToolMessage):
+        return ['t', m.content, m.tool_call_id]
+    raise ValueError(f'Cannot serialize message of type {type(m).__name__}')
+
+_MESSAGE_DECODERS = {
+    'u': HumanMessage,
+    'a': AIMessage,
+    'c': AICallToolMessage,
+    't': ToolMessage
+}
+
+def _decode_message(record: list) -> Message:
+    return _MESSAGE_DECODERS[record[0]](*record[1:])
+
+def _pack(document: dict, binary: bool) -> bytes:
+    if binary:
+        if msgpack is None:
+            raise ImportError('Binary format requires msgpack, install it with `pip install msgpack`')
+        return msgpack.packb(document, use_bin_type=True)
+    return _fastjson.dumpb(document)
+
+def _unpack(data: bytes | str) -> dict:
+    if isinstance(data, str) or data[:1] == b'{':
+        return _fastjson.loads(data)
+    if msgpack is None:
+        raise ImportError('Binary format requires msgpack, install it with `pip install msgpack`')
+    return msgpack.unpackb(data, raw=False)
+
+def _check_messages(messages: tuple) -> None:
+    for m in messages:
+        if not isinstance(m, Message):
+            raise ValueError('Message must be an instance of the Message class')
+        if isinstance(m, SystemMessage):
+            raise ValueError('Please set the system message using the system_message property')
+
+class MemoryConflictError(Exception):
+    """Another turn was committed to an optimistic memory since this turn began."""
+
+class Transaction:
+
+    def __init__(self, memory: Memory, optimistic: bool = False):
+        """
+        The messages of one turn, staged until the turn completes and then committed to the memory
+        together, so concurrent turns on the same memory never interleave their messages.
+
+        Args:
+            memory: The memory to commit to.
+
+            optimistic: If True, committing fails with `MemoryConflictError` when another turn
+                has been committed since this one began, instead of appending after it.
+        """
+        self.memory = memory
+        self.optimistic = optimistic
+        self.base_version = memory.version
+        self._staged: list[Message] = []
+        self._done = False
+
+    def update(self, *args) -> None:
+        _check_messages(args)
+        self._staged.extend(args)
+
+    def __iter__(self):
+        """The memory's messages as if the staged messages were already committed."""
+        memory = self.memory
+        yield from memory._window(memory._messages[-memory.max_turns*2:] + self._staged)
+
+    def commit(self) -> None:
+        if self._done:
+            return
+        if self.optimistic and self.memory.version != self.base_version:
+            raise MemoryConflictError(
+                f'Memory was updated by another turn (version {self.base_version} -> {self.memory.version})'
+            )
+        self._done = True
+        self.memory._messages.extend(self._staged)
+        self.memory.version += 1
+        self.memory._summarize_evicted()
+
+    def rollback(self) -> None:
+        self._done = True
+        self._staged.clear()
+
+    def __enter__(self) -> Transaction:
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+
 class Memory:
 
-    def __init__(self, max_turns: int = 5):
-        self._messages: list[Message] = []
+    def __init__(
+        self,
+        max_turns: int = 5,
+        summarizer: Summarizer = None,
+        optimistic: bool = False
+    ):
+        """
+        Args:
+            max_turns: The maximum number of turns sent to the model.
+
+            summarizer: If given, the messages evicted from the `max_turns` window are condensed
+                in the background into a rolling summary, which is sent right after the system message.
+
+            optimistic: If True, a turn fails with `MemoryConflictError` when another turn on this memory
+                finished while it was running. By default the later turn is appended after the earlier one.
+        """
+        self._messages: _MessageLog = _MessageLog()
         self._system_message: SystemMessage = None
         self.max_turns = max_turns
+        self.summarizer = summarizer
+        self.optimistic = optimistic
+        # Incremented on each change of the messages, for optimistic transactions
+        self.version = 0
+        # (summary, number of messages folded into the summary)
+        self._summary: tuple[str, int] = ('', 0)
+        self._lock: asyncio.Lock = None
+        # Number of messages already written by a checkpoint or dumps_delta(),
+        # None once one of them was popped, until the next checkpoint
+        self._dumped: int | None = 0
+        # The summary as of the last checkpoint or dumps_delta()
+        self._dumped_summary: tuple[str, int] = self._summary
 
     @property
     def system_message(self) -> SystemMessage:
@@ -114,60 +544,229 @@ class Memory:
             raise ValueError('System message must be an instance of the SystemMessage class')
         self._system_message = system_message
 
+    @property
+    def summary(self) -> str:
+        """The rolling summary of the messages evicted from the `max_turns` window."""
+        return self._summary[0]
+
+    @property
+    def lock(self) -> asyncio.Lock:
+        """Hold it around a whole turn to run the concurrent turns on this memory one by one."""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        return self._lock
+
     def update(self, *args) -> None:
-        for m in args:
-            if not isinstance(m, Message):
-                raise ValueError('Message must be an instance of the Message class')
-            if isinstance(m, SystemMessage):
-                raise ValueError('Please set the system message using the system_message property')
-        for m in args:
-            self._messages.append(m)
+        _check_messages(args)
+        self._messages._tail.extend(args)
+        self.version += 1
+        if self.summarizer is not None:
+            self._summarize_evicted()
+
+    def _summarize_evicted(self) -> None:
+        """
+        Hand the messages pushed out of the `max_turns` window to the summarizer as soon as they leave it,
+        so the summary is written while the user types the next message rather than after the next request.
+        """
+        evicted = len(self._messages) - self.max_turns * 2
+        if self.summarizer is not None and evicted > 0:
+            # Non-blocking, the summary catches up in the background
+            self.summarizer.submit(self, evicted)
 
     def pop(self) -> Message:
-        return self._messages.pop()
+        self.version += 1
+        message = self._messages.pop()
+        if self._dumped is not None and len(self._messages) < self._dumped:
+            # A message already written is gone, the deltas can't express it
+            self._dumped = None
+        return message
+
+    def fork(self) -> Memory:
+        """
+        Branch the conversation in O(1): the branch shares all the current messages with this memory,
+        and the messages appended afterwards to either of them are private to that one.
+
+        The system message and the configuration (summarizer...) are shared too, a `RecallMemory` branch
+        gets its own recall index on top of the shared one.
+        """
+        branch = copy.copy(self)
+        branch._messages = self._messages.fork()
+        branch._lock = None
+        return branch
+
+    def _state(self) -> dict:
+        """Everything but the messages that a snapshot restores."""
+        return {
+            'max_turns': self.max_turns,
+            'system': self._system_message.content if self._system_message else None,
+            'summary': list(self._summary)
+        }
+
+    def _set_state(self, state: dict) -> None:
+        self.max_turns = state['max_turns']
+        self._system_message = SystemMessage(state['system']) if state['system'] is not None else None
+        self._summary = tuple(state['summary'])
+
+    def dumps(self, binary: bool = False, checkpoint: bool = False) -> bytes:
+        """
+        Serialize every message (including those outside the `max_turns` window) and the system message.
+
+        Args:
+            binary: Use msgpack instead of JSON. Requires msgpack.
+
+            checkpoint: Make this snapshot the base of the next `dumps_delta`. Otherwise the memory is
+                left as is, so snapshots taken for other purposes don't break a chain of deltas.
+
+        Returns:
+            A versioned snapshot, to be restored with `Memory.loads` or `memory.apply`.
+        """
+        if checkpoint:
+            self.mark_dumped()
+        return _pack({
+            'v': FORMAT_VERSION,
+            'state': self._state(),
+            'start': 0,
+            'messages': [_encode_message(m) for m in self._messages]
+        }, binary)
+
+    def mark_dumped(self) -> None:
+        """Start the next `dumps_delta` from the current messages and summary."""
+        self._dumped = len(self._messages)
+        self._dumped_summary = self._summary
+
+    def dumps_delta(self, binary: bool = False) -> bytes:
+        """
+        Serialize only the messages added since the last `dumps(checkpoint=True)`/`dumps_delta`, for cheap checkpoints,
+        e.g. append the deltas to a Redis list and `apply` them in order to the restored snapshot.
+        The summary is included when it changed since then.
+        """
+        if self._dumped is None:
+            raise ValueError('Messages were removed since the last dump, dump a full snapshot with dumps(checkpoint=True)')
+        start, self._dumped = self._dumped, len(self._messages)
+        document = {
+            'v': FORMAT_VERSION,
+            'start': start,
+            'messages': [_encode_message(m) for m in self._messages[start:]]
+        }
+        if self._summary is not self._dumped_summary:
+            # Read once, the summarizer may replace it meanwhile
+            self._dumped_summary = summary = self._summary
+            document['summary'] = list(summary)
+        return _pack(document, binary)
+
+    def apply(self, data: bytes | str) -> Memory:
+        """Restore a snapshot into this memory (replacing its messages), or append a delta to it."""
+        document = _unpack(data)
+        if document.get('v') != FORMAT_VERSION:
+            raise ValueError(f'Unsupported memory format version: {document.get("v")}')
+        messages = [_decode_message(r) for r in document['messages']]
+        if 'state' in document:
+            self._set_state(document['state'])
+            self._messages = _MessageLog(None, messages)
+        else:
+            if document['start'] != len(self._messages):
+                raise ValueError(f'Delta starts at message {document["start"]}, but memory has {len(self._messages)} messages')
+            self._messages.extend(messages)
+            if 'summary' in document:
+                self._summary = tuple(document['summary'])
+        self.mark_dumped()
+        self.version += 1
+        self._summarize_evicted()
+        return self
+
+    @classmethod
+    def loads(cls, data: bytes | str) -> Memory:
+        """Create a memory from a snapshot made by `dumps`."""
+        return cls().apply(data)
+
+    def transaction(self, optimistic: bool = None) -> Transaction:
+        """Stage the messages of a turn, see `Transaction`."""
+        return Transaction(self, self.optimistic if optimistic is None else optimistic)
+
+    def _preamble(self, messages: list[Message]) -> list[Message]:
+        """Messages sent before the `max_turns` window."""
+        preamble = []
+        if self._system_message:
+            preamble.append(self._system_message)
+        if summary := self._summary[0]:
+            preamble.append(SystemMessage(f'Summary of the earlier conversation:\n{summary}'))
+        return preamble
+
+    def _window(self, messages: list[Message]) -> list[dict]:
+        preamble = self._preamble(messages)
+        messages = messages[-self.max_turns*2:]
+        return [dict(m) for m in preamble + messages]
 
     def __iter__(self):
         """Return messages limited by max_turns, for use as the 'messages' parameter in the OpenAI module."""
-        messages = self._messages
-        if len(messages) > self.max_turns * 2:
-            messages = messages[-self.max_turns*2:]
-        if self._system_message:
-            messages = [self._system_message] + messages
-        yield from [dict(m) for m in messages]
+        yield from self._window(self._messages)
+
+    def render(
+        self,
+        last: int = None,
+        page: int = None,
+        page_size: int = 20,
+        max_content: int | None = MAXCONTENT,
+        plain: bool = False,
+        file: TextIO = None
+    ) -> str | None:
+        """
+        Tabular display of the chat messages.
+
+        Args:
+            last: Only show the last `last` messages.
+
+            page: Only show the `page`-th (from 0) page of `page_size` messages.
+
+            max_content: Contents longer than this are cut before being formatted. None to show them whole.
+
+            plain: Without ANSI colors, e.g. for log files.
+
+            file: If given, rows are written to this file-like object one by one, instead of being
+                joined into a string.
+
+        Returns:
+            The table, or None if `file` is given.
+        """
+        if last is not None:
+            messages = self._messages[-last:] if last > 0 else []
+        elif page is not None:
+            messages = self._messages[page * page_size:(page + 1) * page_size]
+        else:
+            messages = self._messages
+
+        def rows():
+            if self._system_message:
+                yield 'system', _truncate(self._system_message.content, max_content), CS.red
+            if summary := self._summary[0]:
+                yield 'summary', _truncate(summary, max_content), CS.red
+            for m in messages:
+                if isinstance(m, HumanMessage):
+                    yield 'user', _truncate(m.content, max_content), CS.purple
+                elif isinstance(m, AIMessage):
+                    yield 'assistant', _truncate(m.content, max_content), CS.blue
+                elif isinstance(m, AICallToolMessage):
+                    yield 'assistant', _format_tool_call(m, max_content), CS.yellow
+                elif isinstance(m, ToolMessage):
+                    yield 'tool', _truncate(m.content, max_content), CS.green
+
+        buffer = None
+        if file is None:
+            file = buffer = io.StringIO()
+        _write_table(rows, file, plain)
+        if buffer is not None:
+            return buffer.getvalue().rstrip('\n')
 
     def __str__(self):
         """Tabular display of all chat messages"""
-        r = [['Role', 'Content']]
-        if self._system_message:
-            r.append([CS.red('system'), CS.red(self._system_message.content)])
-        for m in self._messages:
-            if isinstance(m, HumanMessage):
-                role = CS.purple('user')
-                content = CS.purple(m.content)
-            elif isinstance(m, AIMessage):
-                role = CS.blue('assistant')
-                content = CS.blue(m.content)
-            elif isinstance(m, AICallToolMessage):
-                role = CS.yellow('assistant')
-                try:
-                    tool_args = json.loads(m.tool_args)
-                    formatted_args = ', '.join(
-                        f'{k}="{v}"' if isinstance(v, str) else f'{k}={v}'
-                        for k, v in tool_args.items()
-                    )
-                    content = CS.yellow(f"{m.tool_name}({formatted_args})")
-                except:
-                    content = CS.yellow(f"{m.tool_name}(???)")
-            elif isinstance(m, ToolMessage):
-                role = CS.green('tool')
-                content = CS.green(m.content)
-
-            r.append([role, content])
-        return tabulate(r, headers='firstrow', tablefmt='grid', maxcolwidths=[None, MAXCOLWIDTH])
+        return self.render()
 
 __all__ = [
     'Memory',
+    'Transaction',
+    'MemoryConflictError',
     'SystemMessage',
+    'PromptTemplate',
     'HumanMessage',
     'AIMessage',
     'AICallToolMessage',
@@ -0,0 +1,347 @@
+from __future__ import annotations
+
+from . import _fastjson
+
+from collections import defaultdict, deque
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+import cProfile
+import os
+import pstats
+import random
+import re
+import sys
+import threading
+import time
+
+_current_session: ContextVar[str] = ContextVar('crazyagent_profile_session', default='default')
+
+class _NullTurn:
+    """Stands for a turn which is not sampled, every hook is a no-op."""
+
+    def phase(self, name: str, blocking: bool = True):
+        return nullcontext()
+
+    def tool(self, name: str, blocking: bool = True):
+        return nullcontext()
+
+    def iterate(self, chunks):
+        return chunks
+
+    def aiterate(self, chunks):
+        return chunks
+
+    def finish(self) -> None:
+        pass
+
+_NULL_TURN = _NullTurn()
+
+class TurnProfile(_NullTurn):
+
+    def __init__(self, profiler: Profiler, session: str):
+        """The profile of one turn of a chat, created by `Profiler.turn`."""
+        self.profiler = profiler
+        self.session = session
+        self.started = time.time()
+        self._wall = time.perf_counter()
+        self._cpu = time.thread_time()
+        self.phases: dict[str, float] = defaultdict(float)
+        self.tools: list[dict] = []
+        self._done = False
+
+    @contextmanager
+    def phase(self, name: str, blocking: bool = True):
+        """
+        Time a part of the turn, e.g. 'provider', 'memory' or 'tool:get_weather'.
+
+        Args:
+            blocking: Whether the thread runs only this turn meanwhile. Stack samples are attributed to
+                the phase only if so, since while a coroutine awaits the event loop runs other turns.
+        """
+        if blocking:
+            self.profiler._enter(self.session, name)
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] += time.perf_counter() - t
+            if blocking:
+                self.profiler._exit()
+
+    @contextmanager
+    def tool(self, name: str, blocking: bool = True):
+        """Time a tool call, and run it under cProfile if it is blocking."""
+        profile = self.profiler._tool_profile() if blocking else None
+        cpu = time.thread_time()
+        t = time.perf_counter()
+        try:
+            with self.phase(f'tool:{name}', blocking):
+                yield
+        finally:
+            wall = time.perf_counter() - t
+            if profile is not None:
+                profile.disable()
+                self.profiler._add_tool_stats(self.session, name, profile)
+            record = {'name': name, 'wall': wall}
+            if blocking:
+                record['cpu'] = time.thread_time() - cpu
+            self.tools.append(record)
+
+    def iterate(self, chunks):
+        """Wrap a provider stream, the time spent waiting for each chunk goes to the 'provider' phase."""
+        chunks = iter(chunks)
+        while True:
+            with self.phase('provider'):
+                try:
+                    chunk = next(chunks)
+                except StopIteration:
+                    return
+            yield chunk
+
+    async def aiterate(self, chunks):
+        chunks = aiter(chunks)
+        while True:
+            with self.phase('provider', blocking=False):
+                try:
+                    chunk = await anext(chunks)
+                except StopAsyncIteration:
+                    return
+            yield chunk
+
+    def finish(self) -> None:
+        """Record the turn, called once it completes. Turns which fail or are abandoned are not recorded."""
+        if self._done:
+            return
+        self._done = True
+        wall = time.perf_counter() - self._wall
+        self.profiler._add_turn(self.session, {
+            'started': self.started,
+            'wall': wall,
+            # Only meaningful for the sync methods, the event loop runs other turns in the same thread
+            'cpu': time.thread_time() - self._cpu,
+            'phases': dict(self.phases),
+            'other': wall - sum(self.phases.values()),
+            'tools': self.tools
+        })
+
+class Profiler:
+
+    def __init__(
+        self,
+        path: str = None,
+        sample_rate: float = 1.0,
+        interval: float = 0.005,
+        cpu_profile: bool = True,
+        max_turns: int = 1000
+    ):
+        """
+        Opt-in profiling of chat turns: where the time of each turn went (provider, tools, memory),
+        wall-clock stack samples in the folded format of flamegraphs, and a cProfile of each tool.
+
+        Args:
+            path: The directory `write` saves the profiles of each session to.
+
+            sample_rate: The fraction of turns profiled, e.g. 0.01 to profile 1% of the traffic in production.
+
+            interval: Seconds between two stack samples, 0 to disable the sampler.
+
+            cpu_profile: Run the blocking tool calls under cProfile.
+
+            max_turns: The number of turn records kept per session.
+        """
+        if not 0 <= sample_rate <= 1:
+            raise ValueError('sample_rate must be in range [0, 1]')
+        self.path = path
+        self.sample_rate = sample_rate
+        self.interval = interval
+        self.cpu_profile = cpu_profile
+        self.max_turns = max_turns
+        self._turns: dict[str, deque[dict]] = defaultdict(lambda: deque(maxlen=self.max_turns))
+        self._stacks: dict[str, dict[str, int]] = defaultdict(lambda: defaultdict(int))
+        self._tool_stats: dict[tuple[str, str], pstats.Stats] = {}
+        # thread id -> (session, stack of phase names) of the threads in a blocking phase
+        self._active: dict[int, tuple[str, list[str]]] = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._sampler: threading.Thread = None
+        self._closed = threading.Event()
+
+    @contextmanager
+    def session(self, session_id: str):
+        """The turns started inside are attributed to this session, in threads and asyncio tasks alike."""
+        token = _current_session.set(str(session_id))
+        try:
+            yield
+        finally:
+            _current_session.reset(token)
+
+    def turn(self) -> TurnProfile | _NullTurn:
+        """Start profiling a turn, unless it is not sampled."""
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return _NULL_TURN
+        return TurnProfile(self, _current_session.get())
+
+    # ---------------- recording ----------------
+
+    def _enter(self, session: str, phase: str) -> None:
+        tid = threading.get_ident()
+        with self._lock:
+            if tid in self._active:
+                self._active[tid][1].append(phase)
+            else:
+                self._active[tid] = (session, [phase])
+        if self.interval and self._sampler is None:
+            self._start_sampler()
+
+    def _exit(self) -> None:
+        tid = threading.get_ident()
+        with self._lock:
+            phases = self._active[tid][1]
+            phases.pop()
+            if not phases:
+                del self._active[tid]
+
+    def _tool_profile(self) -> cProfile.Profile | None:
+        # A thread can only run one profiler at a time, nested or concurrent tool calls are timed only
+        if not self.cpu_profile or getattr(self._local, 'profiling', False) or sys.getprofile() is not None:
+            return None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:  # another profiler is active
+            return None
+        self._local.profiling = True
+        return profile
+
+    def _add_tool_stats(self, session: str, tool: str, profile: cProfile.Profile) -> None:
+        self._local.profiling = False
+        with self._lock:
+            stats = self._tool_stats.get((session, tool))
+            if stats is None:
+                self._tool_stats[(session, tool)] = pstats.Stats(profile)
+            else:
+                stats.add(profile)
+
+    def _add_turn(self, session: str, record: dict) -> None:
+        with self._lock:
+            self._turns[session].append(record)
+
+    def close(self) -> None:
+        """Stop the stack sampler thread; the turns are still timed, but no longer sampled."""
+        self._closed.set()
+        sampler = self._sampler
+        if sampler is not None and sampler is not threading.current_thread():
+            sampler.join()
+
+    def _start_sampler(self) -> None:
+        with self._lock:
+            if self._sampler is not None or self._closed.is_set():
+                return
+            self._sampler = threading.Thread(target=self._sample, name='crazyagent-profiler', daemon=True)
+        self._sampler.start()
+
+    def _sample(self) -> None:
+        while not self._closed.wait(self.interval):
+            with self._lock:
+                if not self._active:
+                    continue
+                active = [(tid, session, tuple(phases)) for tid, (session, phases) in self._active.items()]
+            frames = sys._current_frames()
+            for tid, session, phases in active:
+                frame = frames.get(tid)
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                    frame = frame.f_back
+                key = ';'.join((*phases, *reversed(stack)))
+                with self._lock:
+                    self._stacks[session][key] += 1
+
+    # ---------------- output ----------------
+
+    @property
+    def sessions(self) -> list[str]:
+        with self._lock:
+            return sorted(set(self._turns) | set(self._stacks) | {s for s, _ in self._tool_stats})
+
+    def turns(self, session: str = 'default') -> list[dict]:
+        """
+        The records of the profiled turns of the session, e.g.:
+            {
+                'started': 1730000000.0, 'wall': 2.31, 'cpu': 0.12,
+                'phases': {'memory': 0.001, 'provider': 1.9, 'tool:get_weather': 0.4},
+                'other': 0.009,
+                'tools': [{'name': 'get_weather', 'wall': 0.4, 'cpu': 0.01}]
+            }
+        In stream mode, 'other' includes the time the caller spent between two chunks.
+        """
+        with self._lock:
+            return list(self._turns.get(session, ()))
+
+    def folded(self, session: str = 'default') -> str:
+        """
+        The stack samples of the session in the folded format ('frame;frame;frame count' per line),
+        as read by flamegraph.pl, speedscope or inferno. Each stack starts with the phase it was taken in.
+        """
+        with self._lock:
+            stacks = dict(self._stacks.get(session, {}))
+        return ''.join(f'{stack} {count}\n' for stack, count in sorted(stacks.items()))
+
+    def tool_stats(self, session: str, tool: str) -> pstats.Stats | None:
+        """The cumulated cProfile of a tool in the session."""
+        return self._tool_stats.get((session, tool))
+
+    def write(self, session: str = None, reset: bool = True) -> list[str]:
+        """
+        Save the profiles of a session (all of them by default) to `path`:
+            <session>.folded: the stack samples, for flamegraphs,
+            <session>.turns.json: the turn records,
+            <session>.<tool>.prof: the cProfile of each tool, for pstats or snakeviz.
+
+        Args:
+            reset: Drop the saved profiles from memory, so the next write only has the new turns.
+
+        Returns:
+            The paths of the written files.
+        """
+        if self.path is None:
+            raise ValueError('Profiler has no path to write to')
+        os.makedirs(self.path, exist_ok=True)
+        written = []
+        for s in ([session] if session is not None else self.sessions):
+            name = re.sub(r'[^\w.-]', '_', s)
+            files = {
+                f'{name}.folded': self.folded(s),
+                f'{name}.turns.json': _fastjson.dumps(self.turns(s)),
+            }
+            for file, content in files.items():
+                file = os.path.join(self.path, file)
+                with open(file, 'w', encoding='utf-8') as f:
+                    f.write(content)
+                written.append(file)
+            for (stats_session, tool), stats in list(self._tool_stats.items()):
+                if stats_session == s:
+                    file = os.path.join(self.path, f'{name}.{tool}.prof')
+                    stats.dump_stats(file)
+                    written.append(file)
+            if reset:
+                self.reset(s)
+        return written
+
+    def reset(self, session: str = None) -> None:
+        with self._lock:
+            if session is None:
+                self._turns.clear()
+                self._stacks.clear()
+                self._tool_stats.clear()
+                return
+            self._turns.pop(session, None)
+            self._stacks.pop(session, None)
+            for key in [k for k in self._tool_stats if k[0] == session]:
+                del self._tool_stats[key]
+
+__all__ = [
+    'Profiler',
+    'TurnProfile'
+]
@@ -0,0 +1,384 @@
+from __future__ import annotations
+
+from .memory import Memory, Message, HumanMessage, SystemMessage
+from .compaction import format_message
+from . import _fastjson
+
+from collections import Counter, defaultdict
+from typing import Callable, Sequence, TYPE_CHECKING
+import bisect
+import heapq
+import math
+import os
+import re
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+if TYPE_CHECKING:
+    from .compaction import Summarizer
+
+# Latin words and digits as whole tokens, CJK text as overlapping character bigrams,
+# which works well enough for Chinese without a word segmenter.
+_WORD_RE = re.compile(r'[a-z0-9_]+|[一-鿿]+')
+
+def tokenize(text: str) -> list[str]:
+    tokens = []
+    for word in _WORD_RE.findall(text.lower()):
+        if '一' <= word[0] <= '鿿':
+            if len(word) == 1:
+                tokens.append(word)
+            else:
+                tokens.extend(word[i:i + 2] for i in range(len(word) - 1))
+        else:
+            tokens.append(word)
+    return tokens
+
+class _DocStore:
+    """Append-only store of the indexed texts, persisted as JSON lines."""
+
+    def __init__(self, path: str | None):
+        self.texts: list[str] = []
+        self._file = None
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+            file = os.path.join(path, 'docs.jsonl')
+            self._file = file
+            if os.path.exists(file):
+                with open(file, encoding='utf-8') as f:
+                    lines = f.readlines()
+                if lines and not lines[-1].endswith('\n'):
+                    # Torn by a crash in the middle of a write, dropped so the next lines start clean
+                    self.texts = [_fastjson.loads(line) for line in lines[:-1] if line.strip()]
+                    self.truncate(len(self.texts))
+                else:
+                    self.texts = [_fastjson.loads(line) for line in lines if line.strip()]
+
+    def extend(self, texts: list[str]) -> None:
+        self.texts.extend(texts)
+        if self._file is not None:
+            with open(self._file, 'a', encoding='utf-8') as f:
+                f.writelines(_fastjson.dumps(t) + '\n' for t in texts)
+
+    def truncate(self, n: int) -> None:
+        """Keep the first `n` texts, on disk too."""
+        del self.texts[n:]
+        if self._file is not None:
+            tmp = f'{self._file}.{os.getpid()}.tmp'
+            with open(tmp, 'w', encoding='utf-8') as f:
+                f.writelines(_fastjson.dumps(t) + '\n' for t in self.texts)
+            os.replace(tmp, self._file)
+
+    def __len__(self) -> int:
+        return len(self.texts)
+
+class BM25Index:
+
+    def __init__(self, path: str = None, k1: float = 1.5, b: float = 0.75):
+        """
+        Lexical index ranked by Okapi BM25. Needs no embedding model.
+
+        Args:
+            path: The directory to persist the index to. If None, the index lives in memory only.
+        """
+        self.k1 = k1
+        self.b = b
+        self._docs = _DocStore(path)
+        # token -> [(doc id, term frequency), ...]
+        self._postings: dict[str, list[tuple[int, int]]] = defaultdict(list)
+        self._lengths: list[int] = []
+        self._add_postings(self._docs.texts)
+
+    def __len__(self) -> int:
+        return len(self._docs)
+
+    def spawn(self) -> BM25Index:
+        """An empty in-memory index with the same settings."""
+        return BM25Index(k1=self.k1, b=self.b)
+
+    def add(self, texts: list[str]) -> None:
+        self._docs.extend(texts)
+        self._add_postings(texts)
+
+    def _add_postings(self, texts: list[str]) -> None:
+        for text in texts:
+            doc_id = len(self._lengths)
+            tokens = tokenize(text)
+            self._lengths.append(len(tokens))
+            for token, tf in Counter(tokens).items():
+                self._postings[token].append((doc_id, tf))
+
+    def search(self, query: str, top_k: int = 3, limit: int = None) -> list[tuple[str, float]]:
+        """
+        Args:
+            limit: Only search the first `limit` documents, e.g. those indexed before a memory was forked.
+        """
+        n = len(self._lengths) if limit is None else min(limit, len(self._lengths))
+        if n == 0:
+            return []
+        avg_length = sum(self._lengths if limit is None else self._lengths[:n]) / n or 1
+        scores: dict[int, float] = defaultdict(float)
+        for token in set(tokenize(query)):
+            postings = self._postings.get(token)
+            if postings and limit is not None:
+                # Postings are sorted by doc id
+                postings = postings[:bisect.bisect_left(postings, (n,))]
+            if not postings:
+                continue
+            idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+            for doc_id, tf in postings:
+                norm = self.k1 * (1 - self.b + self.b * self._lengths[doc_id] / avg_length)
+                scores[doc_id] += idf * tf * (self.k1 + 1) / (tf + norm)
+        best = heapq.nlargest(top_k, scores.items(), key=lambda item: item[1])
+        return [(self._docs.texts[doc_id], score) for doc_id, score in best]
+
+class VectorIndex:
+
+    def __init__(
+        self,
+        embed: Callable[[list[str]], Sequence[Sequence[float]]],
+        path: str = None,
+        approximate: bool = False,
+        n_bits: int = 12
+    ):
+        """
+        Embedding index searched by cosine similarity. Requires numpy.
+
+        Args:
+            embed: Turns a batch of texts into a batch of vectors, e.g. a local sentence embedding model.
+
+            path: The directory to persist the index to. Vectors are appended to a raw float32 file
+                which is memory-mapped on startup, so loading a large index costs almost nothing.
+
+            approximate: Only rerank the documents which fall in the same random hyperplane bucket
+                as the query (LSH), instead of scanning every vector.
+
+            n_bits: The number of hyperplanes of the approximate index.
+        """
+        if np is None:
+            raise ImportError('VectorIndex requires numpy, install it with `pip install numpy`')
+        self.embed = embed
+        self.approximate = approximate
+        self.n_bits = n_bits
+        self._docs = _DocStore(path)
+        self._file = None if path is None else os.path.join(path, 'vectors.f32')
+        # The dimension of the vectors, persisted next to them so a torn file is detected on load
+        self._dim_file = None if path is None else os.path.join(path, 'vectors.json')
+        self._dim: int = None
+        self._vectors = None  # (n, dim) float32, L2-normalized
+        # Rows beyond len(self._vectors) are spare capacity of an in-memory index
+        self._buffer = None
+        if self._file is not None and os.path.exists(self._file):
+            self._load()
+        self._planes = None
+        self._buckets: dict[int, list[int]] = defaultdict(list)
+        if self._vectors is not None and approximate:
+            self._add_buckets(self._vectors, 0)
+
+    def __len__(self) -> int:
+        return len(self._docs)
+
+    def spawn(self) -> VectorIndex:
+        """An empty in-memory index with the same settings."""
+        return VectorIndex(self.embed, approximate=self.approximate, n_bits=self.n_bits)
+
+    def _normalize(self, texts: list[str]):
+        vectors = np.asarray(self.embed(texts), dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+    def _signatures(self, vectors) -> list[int]:
+        if self._planes is None:
+            # Seeded, so a persisted index gets the same hyperplanes after a restart
+            self._planes = np.random.default_rng(0).standard_normal((vectors.shape[1], self.n_bits)).astype(np.float32)
+        bits = (vectors @ self._planes) > 0
+        return (bits @ (1 << np.arange(self.n_bits))).tolist()
+
+    def _add_buckets(self, vectors, offset: int) -> None:
+        for i, signature in enumerate(self._signatures(vectors)):
+            self._buckets[signature].append(offset + i)
+
+    def _load(self) -> None:
+        size = os.path.getsize(self._file)
+        if os.path.exists(self._dim_file):
+            with open(self._dim_file, encoding='utf-8') as f:
+                self._dim = _fastjson.loads(f.read())['dim']
+        elif len(self._docs) and size % (4 * len(self._docs)) == 0:
+            # Written before the dimension was stored, from a consistent index
+            self._write_dim(size // (4 * len(self._docs)))
+        elif size:
+            raise ValueError(f'Cannot tell the dimension of the vectors in {self._file}, rebuild the index')
+        if self._dim is None:
+            return
+        # The vectors are written before the texts: after a crash between the two,
+        # or in the middle of one of them, only the documents found in both are kept
+        n = min(size // (4 * self._dim), len(self._docs))
+        if size != n * 4 * self._dim:
+            os.truncate(self._file, n * 4 * self._dim)
+        if len(self._docs) != n:
+            self._docs.truncate(n)
+        if n:
+            self._map()
+
+    def _write_dim(self, dim: int) -> None:
+        tmp = f'{self._dim_file}.{os.getpid()}.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write(_fastjson.dumps({'dim': dim}))
+        os.replace(tmp, self._dim_file)
+        self._dim = dim
+
+    def _map(self) -> None:
+        self._vectors = np.memmap(self._file, dtype=np.float32, mode='r').reshape(len(self._docs), self._dim)
+
+    def _append(self, vectors) -> None:
+        n = 0 if self._vectors is None else len(self._vectors)
+        if self._buffer is None or n + len(vectors) > len(self._buffer):
+            # Doubled, so adding documents one batch at a time stays amortized O(1) per vector
+            capacity = max(n + len(vectors), 2 * (0 if self._buffer is None else len(self._buffer)), 64)
+            buffer = np.empty((capacity, vectors.shape[1]), dtype=np.float32)
+            buffer[:n] = self._vectors
+            self._buffer = buffer
+        self._buffer[n:n + len(vectors)] = vectors
+        self._vectors = self._buffer[:n + len(vectors)]
+
+    def add(self, texts: list[str]) -> None:
+        if not texts:
+            return
+        vectors = self._normalize(texts)
+        offset = len(self._docs)
+        if self._file is not None:
+            if self._dim is None:
+                self._write_dim(vectors.shape[1])
+            elif vectors.shape[1] != self._dim:
+                raise ValueError(f'Expected vectors of dimension {self._dim}, got {vectors.shape[1]}')
+            # Vectors first, so a crash in between leaves extra vectors, which the next load cuts off
+            with open(self._file, 'ab') as f:
+                f.write(vectors.tobytes())
+            self._docs.extend(texts)
+            # Mapped again rather than copied, the vectors stay on disk
+            self._map()
+        else:
+            self._docs.extend(texts)
+            self._append(vectors)
+        if self.approximate:
+            self._add_buckets(vectors, offset)
+
+    def search(self, query: str, top_k: int = 3, limit: int = None) -> list[tuple[str, float]]:
+        """
+        Args:
+            limit: Only search the first `limit` documents, e.g. those indexed before a memory was forked.
+        """
+        if self._vectors is None or limit == 0:
+            return []
+        n = len(self._vectors) if limit is None else min(limit, len(self._vectors))
+        q = self._normalize([query])[0]
+        candidates = None
+        if self.approximate:
+            candidates = self._buckets.get(self._signatures(q[None, :])[0])
+            if candidates is not None and limit is not None:
+                candidates = [i for i in candidates if i < n]
+            # Too few neighbours in the bucket, fall back to the exact scan
+            if candidates is not None and len(candidates) < top_k:
+                candidates = None
+        if candidates is None:
+            ids = np.arange(n)
+            scores = self._vectors[:n] @ q
+        else:
+            ids = np.asarray(candidates)
+            scores = self._vectors[ids] @ q
+        k = min(top_k, len(ids))
+        best = np.argpartition(-scores, k - 1)[:k]
+        best = best[np.argsort(-scores[best])]
+        return [(self._docs.texts[ids[i]], float(scores[i])) for i in best]
+
+class _BranchIndex:
+    """
+    The index of a forked `RecallMemory`: the documents of its parent's index up to the fork, and its own.
+    The parent keeps adding to its index afterwards, the branch never sees those documents.
+    """
+
+    def __init__(self, base: BM25Index | VectorIndex | _BranchIndex):
+        self.base = base
+        self.size = len(base)
+        self.own = base.spawn()
+
+    def __len__(self) -> int:
+        return self.size + len(self.own)
+
+    def spawn(self) -> BM25Index | VectorIndex:
+        return self.own.spawn()
+
+    def add(self, texts: list[str]) -> None:
+        self.own.add(texts)
+
+    def search(self, query: str, top_k: int = 3, limit: int = None) -> list[tuple[str, float]]:
+        if limit is not None and limit <= self.size:
+            return self.base.search(query, top_k, limit)
+        results = self.base.search(query, top_k, self.size)
+        results += self.own.search(query, top_k, None if limit is None else limit - self.size)
+        return heapq.nlargest(top_k, results, key=lambda item: item[1])
+
+class RecallMemory(Memory):
+
+    def __init__(
+        self,
+        max_turns: int = 5,
+        summarizer: Summarizer = None,
+        index: BM25Index | VectorIndex = None,
+        top_k: int = 3,
+        optimistic: bool = False
+    ):
+        """
+        A `Memory` which indexes the messages evicted from the `max_turns` window, and sends the
+        `top_k` snippets most relevant to the latest user message along with the window.
+
+        Args:
+            index: Where the evicted messages are indexed. Defaults to an in-memory `BM25Index`.
+
+            top_k: The maximum number of recalled snippets per request.
+        """
+        super().__init__(max_turns=max_turns, summarizer=summarizer, optimistic=optimistic)
+        self.index = index if index is not None else BM25Index()
+        self.top_k = top_k
+        # Number of messages already added to the index
+        self._indexed = 0
+
+    def fork(self) -> RecallMemory:
+        """
+        Like `Memory.fork`, the branch recalls what was indexed before the fork, and then only the
+        messages evicted from its own window. Its own part of the index lives in memory.
+        """
+        branch = super().fork()
+        branch.index = _BranchIndex(self.index)
+        return branch
+
+    def _state(self) -> dict:
+        return {**super()._state(), 'indexed': self._indexed}
+
+    def _set_state(self, state: dict) -> None:
+        super()._set_state(state)
+        # A fresh index, e.g. from the factory of a SessionStore, holds none of the archived messages:
+        # index them again at the next request
+        self._indexed = state.get('indexed', 0) if len(self.index) else 0
+
+    def _preamble(self, messages: list[Message]) -> list[Message]:
+        preamble = super()._preamble(messages)
+        evicted = len(self._messages) - self.max_turns * 2
+        if evicted > self._indexed:
+            # Incremental, each message is embedded/tokenized exactly once
+            self.index.add([format_message(m) for m in self._messages[self._indexed:evicted]])
+            self._indexed = evicted
+        query = next((m.content for m in reversed(messages) if isinstance(m, HumanMessage)), None)
+        if query and len(self.index):
+            snippets = [text for text, _ in self.index.search(query, self.top_k)]
+            if snippets:
+                preamble.append(SystemMessage('Relevant snippets from the earlier conversation:\n' + '\n'.join(f'- {s}' for s in snippets)))
+        return preamble
+
+__all__ = [
+    'RecallMemory',
+    'BM25Index',
+    'VectorIndex'
+]
@@ -0,0 +1,235 @@
+from __future__ import annotations
+
+from .memory import Memory
+
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Callable
+import asyncio
+import hashlib
+import inspect
+import os
+import sys
+import time
+import weakref
+
+class _Session:
+
+    __slots__ = (
+        'memory',
+        'last_access',
+        'nbytes',
+        'counted'
+    )
+
+    def __init__(self, memory: Memory):
+        self.memory = memory
+        self.last_access = time.monotonic()
+        self.nbytes = 0
+        # Number of messages already accounted in nbytes
+        self.counted = 0
+
+    def refresh_nbytes(self) -> int:
+        """Incrementally account the messages appended since the last call."""
+        messages = self.memory._messages
+        if len(messages) == self.counted:
+            return self.nbytes
+        if len(messages) < self.counted:
+            # Messages were popped, start over
+            self.nbytes, self.counted = 0, 0
+        for m in messages[self.counted:]:
+            self.nbytes += sum(sys.getsizeof(v) for v in vars(m).values() if isinstance(v, str))
+        self.counted = len(messages)
+        return self.nbytes
+
+class SessionStore:
+
+    def __init__(
+        self,
+        factory: Callable[[], Memory] = Memory,
+        max_sessions: int = None,
+        ttl: float = None,
+        max_bytes: int = None,
+        spill_dir: str = None
+    ):
+        """
+        Map session ids to `Memory` objects, evicting the least recently used ones.
+
+        Args:
+            factory: Creates the memory of a new session, e.g. `lambda: Memory(max_turns=10)`.
+                If it has a `session_id` parameter, it gets the id of the session, e.g. to give each
+                session its own persistent recall index:
+                    lambda session_id: RecallMemory(index=BM25Index(path=f'./index/{session_id}'))
+
+            max_sessions: The maximum number of sessions kept in RAM.
+
+            ttl: Sessions idle for more than `ttl` seconds are evicted.
+
+            max_bytes: The budget of the (approximate) size of all messages kept in RAM.
+
+            spill_dir: If given, evicted sessions are written to this directory instead of being dropped,
+                and are reloaded transparently the next time they are accessed.
+        """
+        self.factory = factory
+        try:
+            self._factory_takes_id = 'session_id' in inspect.signature(factory).parameters
+        except (TypeError, ValueError):
+            self._factory_takes_id = False
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        if spill_dir is not None:
+            os.makedirs(spill_dir, exist_ok=True)
+        self._sessions: OrderedDict[str, _Session] = OrderedDict()
+        # Evicted memories still referenced by the application, taken back instead of the older copy on disk
+        self._evicted: weakref.WeakValueDictionary[str, Memory] = weakref.WeakValueDictionary()
+        self.nbytes = 0
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def __contains__(self, session_id: str) -> bool:
+        return session_id in self._sessions or session_id in self._evicted or (
+            self.spill_dir is not None and os.path.exists(self._spill_path(session_id))
+        )
+
+    def get(self, session_id: str) -> Memory:
+        """
+        Return the memory of the session, creating or reloading it if needed.
+
+        The memory may be evicted while you hold it, unless it is used inside `session()`. Writes made to it
+        meanwhile are not lost as long as you keep the reference: the next access takes it back. Its size
+        is accounted at the next access of the store, and again whenever it is the next one to evict.
+        """
+        return self._touch(session_id).memory
+
+    __getitem__ = get
+
+    def lock(self, session_id: str) -> asyncio.Lock:
+        """The lock of the session, hold it while a turn updates the memory."""
+        return self._touch(session_id).memory.lock
+
+    @asynccontextmanager
+    async def session(self, session_id: str):
+        """
+        Hold the session lock for a whole turn, so concurrent turns on the same session don't interleave.
+
+        e.g.:
+            async with store.session(user_id) as memory:
+                response = await llm.ainvoke(prompt, memory=memory)
+        """
+        session = self._touch(session_id)
+        async with session.memory.lock:
+            yield session.memory
+        session.last_access = time.monotonic()
+        if self._sessions.get(session_id) is session:
+            # Keep the LRU order in step with last_access, the TTL check relies on it
+            self._sessions.move_to_end(session_id)
+            self._account(session)
+        self._evict()
+
+    def pop(self, session_id: str) -> Memory | None:
+        """Remove the session from the store (and from disk)."""
+        session = self._sessions.pop(session_id, None)
+        memory = self._evicted.pop(session_id, None)
+        if session is not None:
+            self.nbytes -= session.nbytes
+            memory = session.memory
+        if self.spill_dir is not None:
+            path = self._spill_path(session_id)
+            if os.path.exists(path):
+                if memory is None:
+                    memory = self._load(path, session_id)
+                os.remove(path)
+        return memory
+
+    def evict_expired(self) -> None:
+        """Evict the sessions idle for more than `ttl` seconds, call it periodically."""
+        self._evict()
+
+    def close(self) -> None:
+        """Remove every session, writing them to `spill_dir` if given, e.g. before the process exits."""
+        for session_id, session in list(self._sessions.items()):
+            self._remove(session_id, session)
+
+    def _touch(self, session_id: str) -> _Session:
+        if self._sessions:
+            # The most recently used session is the one usually written to since, through the memory returned by `get`
+            self._account(next(reversed(self._sessions.values())))
+        session = self._sessions.get(session_id)
+        if session is None:
+            memory = self._evicted.pop(session_id, None)
+            if memory is None and self.spill_dir is not None:
+                path = self._spill_path(session_id)
+                # The file is kept until the session is spilled again, in case the process dies meanwhile
+                if os.path.exists(path):
+                    memory = self._load(path, session_id)
+            session = _Session(memory if memory is not None else self._new(session_id))
+            self._sessions[session_id] = session
+        else:
+            self._sessions.move_to_end(session_id)
+            session.last_access = time.monotonic()
+        self._account(session)
+        self._evict(keep=session_id)
+        return session
+
+    def _account(self, session: _Session) -> None:
+        self.nbytes -= session.nbytes
+        self.nbytes += session.refresh_nbytes()
+
+    def _over_budget(self) -> bool:
+        return (
+            (self.max_sessions is not None and len(self._sessions) > self.max_sessions)
+            or (self.max_bytes is not None and self.nbytes > self.max_bytes)
+        )
+
+    def _evict(self, keep: str = None) -> None:
+        now = time.monotonic()
+        while True:
+            # Oldest first, usually only the first session is looked at;
+            # sessions in the middle of a turn are never evicted
+            for session_id, session in self._sessions.items():
+                if session_id == keep or session.memory.lock.locked():
+                    continue
+                if self.max_bytes is not None:
+                    # Writes made through a reference returned by `get` are only seen here
+                    self._account(session)
+                expired = self.ttl is not None and now - session.last_access > self.ttl
+                if not expired and not self._over_budget():
+                    return
+                break
+            else:
+                return
+            self._remove(session_id, session)
+
+    def _remove(self, session_id: str, session: _Session) -> None:
+        del self._sessions[session_id]
+        self.nbytes -= session.nbytes
+        if self.spill_dir is not None:
+            self._dump(session.memory, self._spill_path(session_id))
+        self._evicted[session_id] = session.memory
+
+    def _spill_path(self, session_id: str) -> str:
+        name = hashlib.sha1(str(session_id).encode('utf-8')).hexdigest()
+        return os.path.join(self.spill_dir, f'{name}.mem')
+
+    @staticmethod
+    def _dump(memory: Memory, path: str) -> None:
+        # Written aside and renamed, so a crash never leaves a truncated snapshot
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(memory.dumps())
+        os.replace(tmp, path)
+
+    def _new(self, session_id: str) -> Memory:
+        return self.factory(session_id=session_id) if self._factory_takes_id else self.factory()
+
+    def _load(self, path: str, session_id: str) -> Memory:
+        # The configuration (summarizer, recall index...) comes from the factory, the state from the snapshot
+        with open(path, 'rb') as f:
+            return self._new(session_id).apply(f.read())
+
+__all__ = [
+    'SessionStore'
+]
@@ -0,0 +1,143 @@
+from .core import crazy_tool, Argument
+from crazyagent import _fastjson
+
+import hashlib
+import math
+import mmap
+import os
+import re
+import tempfile
+
+# ----------------------------------------------------
+
+_ARTIFACT_ID_RE = re.compile(r'[0-9a-f]{16}')
+
+class ArtifactStore:
+
+    def __init__(self, path: str = None, page_size: int = 2000):
+        """
+        Content-addressed store of large tool results on local disk.
+
+        Args:
+            path: The directory of the artifacts. Defaults to a directory in the system temp directory.
+
+            page_size: The size (in bytes of UTF-8) of a page returned by `read`.
+        """
+        self.path = path or os.path.join(tempfile.gettempdir(), 'crazyagent-artifacts')
+        self.page_size = page_size
+        os.makedirs(self.path, exist_ok=True)
+        self.read_tool = self._make_read_tool()
+
+    def _file(self, artifact_id: str) -> str:
+        # The id comes from the model, never let it point outside the store
+        if not _ARTIFACT_ID_RE.fullmatch(artifact_id):
+            raise ValueError(f'Invalid artifact id: {artifact_id}')
+        return os.path.join(self.path, artifact_id)
+
+    def put(self, content: str) -> tuple[str, int]:
+        """
+        Store the content, identical contents are stored once.
+
+        Returns:
+            The artifact id and its number of pages.
+        """
+        data = content.encode('utf-8')
+        artifact_id = hashlib.sha256(data).hexdigest()[:16]
+        file = self._file(artifact_id)
+        if not os.path.exists(file):
+            # Unique per call, concurrent turns may store the same result at once
+            fd, tmp = tempfile.mkstemp(dir=self.path, prefix=f'{artifact_id}.', suffix='.tmp')
+            try:
+                with open(fd, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp, file)
+            except OSError:
+                # Lost the race to another writer of the same content (e.g. the file is mapped on Windows)
+                if not os.path.exists(file):
+                    raise
+            finally:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+        return artifact_id, math.ceil(len(data) / self.page_size)
+
+    def read(self, artifact_id: str, page: int = 0) -> str:
+        """Read one page of the artifact, through a memory map so only that page is loaded."""
+        file = self._file(artifact_id)
+        if not os.path.exists(file):
+            raise ValueError(f'Artifact {artifact_id} not found')
+        with open(file, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            size = len(mm)
+            start = page * self.page_size
+            if page < 0 or start >= size:
+                raise ValueError(f'Page {page} out of range, the artifact has {math.ceil(size / self.page_size)} pages')
+            end = min(start + self.page_size, size)
+            return mm[self._char_start(mm, start):self._char_start(mm, end)].decode('utf-8')
+
+    @staticmethod
+    def _char_start(mm: mmap.mmap, pos: int) -> int:
+        """Move back to the first byte of a UTF-8 character, so pages never split one."""
+        while 0 < pos < len(mm) and (mm[pos] & 0xC0) == 0x80:
+            pos -= 1
+        return pos
+
+    def _make_read_tool(self) -> callable:
+        @crazy_tool
+        def read_artifact(
+            artifact_id: str = Argument('The artifact_id given in place of a large tool result'),
+            page: int = Argument('Page number, starting from 0', default=0)
+        ) -> str:
+            """
+            Read one page of a large tool result which was stored as an artifact.
+            Only read the pages needed to answer the user.
+            """
+            return self.read(artifact_id, page)
+        return read_artifact
+
+class ResultGovernor:
+
+    def __init__(self, max_chars: int = 4000, preview_chars: int = 1000, store: ArtifactStore = None):
+        """
+        Keep large tool results out of the memory, since every result is sent again with each
+        request of the `max_turns` window.
+
+        Args:
+            max_chars: Results longer than this are replaced by a preview.
+
+            preview_chars: The length of the preview.
+
+            store: If given, the whole result is saved in it and the model gets a `read_artifact` tool
+                to page through it on demand. Otherwise the rest of the result is dropped.
+        """
+        self.max_chars = max_chars
+        self.preview_chars = preview_chars
+        self.store = store
+
+    @property
+    def tools(self) -> list[callable]:
+        """Tools to add to each request."""
+        return [self.store.read_tool] if self.store is not None else []
+
+    def govern(self, content: str, tool_name: str = None) -> str:
+        """Return the content to write into the tool message."""
+        if len(content) <= self.max_chars:
+            return content
+        if self.store is not None and tool_name == self.store.read_tool.__name__:
+            # Pages are already bounded by the page size
+            return content
+        r = {
+            'preview': content[:self.preview_chars],
+            'total_chars': len(content)
+        }
+        if self.store is not None:
+            artifact_id, pages = self.store.put(content)
+            r['artifact_id'] = artifact_id
+            r['pages'] = pages
+            r['hint'] = f'The result is truncated, call read_artifact with artifact_id="{artifact_id}" and page 0 to {pages - 1} to read the rest'
+        else:
+            r['hint'] = 'The result is truncated'
+        return _fastjson.dumps(r)
+
+__all__ = [
+    'ArtifactStore',
+    'ResultGovernor'
+]
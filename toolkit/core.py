@@ -26,7 +26,7 @@ _PYTHON_JSON_TYPE_MAP = {
     list: 'array',
     tuple: 'array',
     str: 'string',
-    int: 'number',
+    int: 'integer',
     float: 'number',
     bool: 'boolean',
     NoneType: 'null'
@@ -56,15 +56,164 @@ class Argument:
         self.required = required
         self.enum = enum
 
+from crazyagent import _fastjson
+
 import inspect
 from collections import defaultdict
 from functools import wraps
-import json
 
+def _float_to_int(value: float) -> int:
+    if not value.is_integer():
+        raise ValueError
+    return int(value)
+
+# (type of the given value, annotated type) -> converter, for values the model commonly gets slightly wrong
+_COERCIONS = {
+    (int, float): float,
+    (float, int): _float_to_int,
+    (str, int): int,
+    (str, float): float,
+    (list, tuple): tuple,
+}
+
+def _compile_checker(types: tuple[type, ...], enum: list | None) -> callable:
+    """Build the function which checks and coerces the value of one parameter."""
+    expected = ' or '.join(dict.fromkeys(_PYTHON_JSON_TYPE_MAP[t] for t in types))
+    coercions = [(src, conv) for (src, dst), conv in _COERCIONS.items() if dst in types]
+    if enum is not None:
+        try:
+            enum_values = frozenset(enum)
+        except TypeError:  # unhashable values, e.g. lists
+            enum_values = enum
+
+    def check(value):
+        # Exact type match, so that bool is not accepted as int
+        if type(value) not in types:
+            for src, conv in coercions:
+                if type(value) is src:
+                    try:
+                        value = conv(value)
+                        break
+                    except ValueError:
+                        pass
+            else:
+                raise ValueError(f'expected {expected}, got {_PYTHON_JSON_TYPE_MAP.get(type(value), type(value).__name__)} {value!r}')
+        if enum is not None:
+            try:
+                allowed = value in enum_values
+            except TypeError:  # unhashable value, e.g. a list for a `list | str` parameter
+                allowed = value in enum
+            if not allowed:
+                raise ValueError(f'must be one of {enum}, got {value!r}')
+        return value
+    return check
+
+def _compile_validator(params: list[tuple[str, tuple[type, ...], Argument]]) -> callable:
+    """
+    Compile the parameters of a tool into a single function, run on every call, which returns
+    the coerced arguments (with defaults filled in) and a list of errors for the model.
+    """
+    checkers = [
+        (name, _compile_checker(types, None if arg.enum is ... else arg.enum), arg.required, arg.default)
+        for name, types, arg in params
+    ]
+    names = frozenset(name for name, _, _ in params)
+
+    def validate(kwargs: dict) -> tuple[dict, list[dict]]:
+        errors = []
+        if not names.issuperset(kwargs):
+            errors.extend({'param': k, 'message': 'unexpected parameter'} for k in kwargs if k not in names)
+        arguments = {}
+        for name, check, required, default in checkers:
+            if name in kwargs:
+                try:
+                    arguments[name] = check(kwargs[name])
+                except ValueError as e:
+                    errors.append({'param': name, 'message': str(e)})
+            elif default is not ...:
+                arguments[name] = default
+            elif required:
+                errors.append({'param': name, 'message': 'missing required parameter'})
+            else:
+                # Left out, the function would get its `Argument` as the value
+                arguments[name] = None
+        return arguments, errors
+    return validate
+
+class ToolResultStream:
+
+    def __init__(self, chunks=None, error: dict = None):
+        """
+        The partial results of a generator tool, iterate it (or async iterate it) to receive them
+        as they arrive. `result` is the content of the tool message, made of the results received so far.
+
+        Args:
+            chunks: The generator (or async generator) returned by the tool function.
+
+            error: The error to report instead of running the tool, e.g. invalid arguments.
+        """
+        self._chunks = chunks
+        self._error = error
+        self.items: list = []
+        self.stopped = False
+
+    def __iter__(self):
+        if self._chunks is None:
+            return
+        try:
+            for chunk in self._chunks:
+                self.items.append(chunk)
+                yield chunk
+        except Exception as e:
+            self._error = {'error': str(e)}
+
+    async def __aiter__(self):
+        if self._chunks is None:
+            return
+        try:
+            if inspect.isasyncgen(self._chunks):
+                async for chunk in self._chunks:
+                    self.items.append(chunk)
+                    yield chunk
+            else:
+                for chunk in self._chunks:
+                    self.items.append(chunk)
+                    yield chunk
+        except Exception as e:
+            self._error = {'error': str(e)}
+
+    def close(self) -> None:
+        """Stop the tool early, the results received so far are kept."""
+        self.stopped = True
+        if inspect.isgenerator(self._chunks):
+            self._chunks.close()
+
+    async def aclose(self) -> None:
+        self.stopped = True
+        if inspect.isasyncgen(self._chunks):
+            await self._chunks.aclose()
+        else:
+            self.close()
+
+    @property
+    def result(self) -> str:
+        if self._error is not None and not self.items:
+            return _fastjson.dumps(self._error)
+        r = {'result': self.items}
+        if self.stopped:
+            r['partial'] = True
+        if self._error is not None:
+            r.update(self._error)
+        try:
+            return _fastjson.dumps(r)
+        except Exception as e:
+            # e.g. a chunk which is not JSON serializable
+            return _fastjson.dumps({'error': str(e)})
 
 def crazy_tool(func: callable) -> callable:
     properties = defaultdict(dict)
     required_s = []
+    params = []
 
     for _, param in inspect.signature(func).parameters.items():
         # param.name is the parameter name, same as _
@@ -81,10 +230,12 @@ def crazy_tool(func: callable) -> callable:
                     raise ValueError(f'Function {func.__name__} only supports parameter types: {_all_supported_types}')
                 param_types.append(_PYTHON_JSON_TYPE_MAP[sub_type])
             properties[param.name]['type'] = param_types
+            python_types = param.annotation.__args__
         else:
             if param.annotation not in _PYTHON_JSON_TYPE_MAP:
                 raise ValueError(f'Function {func.__name__} only supports parameter types: {_all_supported_types}')
             properties[param.name]['type'] = _PYTHON_JSON_TYPE_MAP[param.annotation]
+            python_types = (param.annotation,)
 
         if not isinstance(param.default, Argument):
             raise ValueError(f'Parameter {param.name} of function {func.__name__} must have a default value of type Argument')
@@ -97,6 +248,7 @@ def crazy_tool(func: callable) -> callable:
             required_s.append(param.name)
         if arguement.enum is not ...:
             properties[param.name]['enum'] = arguement.enum
+        params.append((param.name, python_types, arguement))
 
         if not func.__doc__:
             raise ValueError(f'Docstring of function {func.__name__} cannot be empty')
@@ -112,35 +264,63 @@ def crazy_tool(func: callable) -> callable:
             }
         }
 
-    if inspect.iscoroutinefunction(func):
+    validate = _compile_validator(params)
+    invalid_message = f'Invalid arguments for tool {func.__name__}'
+
+    if inspect.isgeneratorfunction(func) or inspect.isasyncgenfunction(func):
+        def stream(**kwargs) -> ToolResultStream:
+            arguments, errors = validate(kwargs)
+            if errors:
+                return ToolResultStream(error={'error': invalid_message, 'details': errors})
+            return ToolResultStream(func(**arguments))
+
+        if inspect.isasyncgenfunction(func):
+            @wraps(func)
+            async def wrap(**kwargs):
+                results = stream(**kwargs)
+                async for _ in results:
+                    pass
+                return results.result
+        else:
+            @wraps(func)
+            def wrap(**kwargs):
+                results = stream(**kwargs)
+                for _ in results:
+                    pass
+                return results.result
+        wrap._is_async = inspect.isasyncgenfunction(func)
+        wrap.stream = stream
+    elif inspect.iscoroutinefunction(func):
         @wraps(func)
         async def wrap(**kwargs):
+            arguments, errors = validate(kwargs)
+            if errors:
+                # Returned to the model right away, so it can fix the call in the next round
+                return _fastjson.dumps({'error': invalid_message, 'details': errors})
             try:
-                for required in required_s:
-                    if required not in kwargs:
-                        raise ValueError(f'Missing required parameter: {required}')
-                r = {'result': await func(**kwargs)}
+                # Serialized inside, a result which is not JSON serializable is an error of the tool too
+                return _fastjson.dumps({'result': await func(**arguments)})
             except Exception as e:
-                r = {'error': str(e)}
-            return json.dumps(r, ensure_ascii=False, separators=(',', ':'), indent=None)
+                return _fastjson.dumps({'error': str(e)})
         wrap._is_async = True
     else:
         @wraps(func)
         def wrap(**kwargs):
+            arguments, errors = validate(kwargs)
+            if errors:
+                return _fastjson.dumps({'error': invalid_message, 'details': errors})
             try:
-                for required in required_s:
-                    if required not in kwargs:
-                        raise ValueError(f'Missing required parameter: {required}')
-                r = {'result': func(**kwargs)}
+                return _fastjson.dumps({'result': func(**arguments)})
             except Exception as e:
-                r = {'error': str(e)}
-            return json.dumps(r, ensure_ascii=False)
+                return _fastjson.dumps({'error': str(e)})
         wrap._is_async = False
         
+    wrap._is_stream = hasattr(wrap, 'stream')
     wrap._tool_definition = tool_definition
     return wrap
 
 __all__ = [
     'Argument',
-    'crazy_tool'
+    'crazy_tool',
+    'ToolResultStream'
 ]
\ No newline at end of file
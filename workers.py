@@ -0,0 +1,368 @@
+from __future__ import annotations
+
+from .session import SessionStore
+from .events import Event, TextDelta, Done
+
+from typing import AsyncIterator, Callable, TYPE_CHECKING
+import asyncio
+import contextlib
+import itertools
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import zlib
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+if TYPE_CHECKING:
+    from .chat import Chat
+    from ._response import Response
+
+# Messages from the workers: (request id, kind, payload)
+_EVENT = 'event'
+_ERROR = 'error'
+_END = 'end'
+_METRICS = 'metrics'
+# Posted once every worker is joined, stops the reader
+_EXIT = 'exit'
+
+# How often the reader checks that the workers are alive while no message arrives
+_HEALTH_INTERVAL = 0.5
+
+class WorkerError(Exception):
+    """A request failed in a worker, the message is the repr of the original exception."""
+
+def _worker_main(
+    index: int,
+    chat_factory: Callable[[], Chat],
+    tools: list[callable],
+    store_factory: Callable[[], SessionStore],
+    requests: multiprocessing.Queue,
+    responses: multiprocessing.Queue
+) -> None:
+    """The entry point of a worker process: runs the turns of its sessions on its own event loop."""
+    chat = chat_factory()
+    store = store_factory()
+    started = time.monotonic()
+
+    async def run_turn(request_id: int, session_id: str, user_prompt: str, temperature: float | None) -> None:
+        try:
+            async with store.session(session_id) as memory:
+                async for event in chat.astream_events(user_prompt, temperature, memory, tools):
+                    responses.put((request_id, _EVENT, event))
+            responses.put((request_id, _END, None))
+        except Exception as e:
+            responses.put((request_id, _ERROR, repr(e)))
+
+    async def main() -> None:
+        loop = asyncio.get_running_loop()
+        inbox: asyncio.Queue = asyncio.Queue()
+
+        def read() -> None:
+            # multiprocessing queues only have blocking gets, read them in a thread; None means stop
+            while True:
+                message = requests.get()
+                loop.call_soon_threadsafe(inbox.put_nowait, message)
+                if message is None:
+                    return
+
+        threading.Thread(target=read, daemon=True).start()
+        tasks: set[asyncio.Task] = set()
+        while (message := await inbox.get()) is not None:
+            request_id, kind, payload = message
+            if kind == _METRICS:
+                metrics = {
+                    'pid': os.getpid(),
+                    'sessions': len(store),
+                    'session_bytes': store.nbytes,
+                    'cpu_time': time.process_time(),
+                    'uptime': time.monotonic() - started
+                }
+                if resource is not None:
+                    metrics['max_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                responses.put((request_id, _METRICS, metrics))
+                continue
+            task = asyncio.create_task(run_turn(request_id, *payload))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        # Draining: finish the turns already accepted
+        if tasks:
+            await asyncio.wait(tasks)
+
+    try:
+        asyncio.run(main())
+    finally:
+        store.close()
+
+class _WorkerStats:
+
+    __slots__ = (
+        'requests',
+        'active',
+        'errors',
+        'busy',
+        'restarts',
+    )
+
+    def __init__(self):
+        self.requests = 0
+        self.active = 0
+        self.errors = 0
+        # Summed duration of the completed requests
+        self.busy = 0.0
+        # Times the process died and was replaced
+        self.restarts = 0
+
+class WorkerPool:
+
+    def __init__(
+        self,
+        chat_factory: Callable[[], Chat],
+        tools: list[callable] = [],
+        workers: int = None,
+        store_factory: Callable[[], SessionStore] = SessionStore
+    ):
+        """
+        Run turns in several processes, to use every core once tools, JSON and memory handling
+        saturate one. Sessions are sharded by a stable hash of their id, so the memory of a session
+        always stays in the same worker.
+
+        The arguments are sent to the workers, so they must be picklable, e.g.:
+            WorkerPool(functools.partial(Deepseek, api_key=key), tools=[get_weather], workers=4)
+
+        Args:
+            chat_factory: Creates the `Chat` of each worker.
+
+            tools: The tools of every turn, module-level `crazy_tool` functions.
+
+            workers: The number of processes, defaults to the number of CPUs.
+
+            store_factory: Creates the `SessionStore` of each worker, e.g. with a TTL and a spill directory.
+                Sessions are spilled to disk when a worker stops.
+
+        A worker which dies, e.g. killed for running out of memory, is replaced by a new process: its
+        running turns fail with a `WorkerError` and the sessions it held in memory are lost, those
+        spilled to disk are loaded again by the new process.
+        """
+        self.chat_factory = chat_factory
+        self.tools = tools
+        self.workers = workers or os.cpu_count() or 1
+        self.store_factory = store_factory
+        self._context = multiprocessing.get_context('spawn')
+        self._processes: list = []
+        self._requests: list[multiprocessing.Queue] = []
+        self._responses: multiprocessing.Queue = None
+        self._reader: threading.Thread = None
+        self._loop: asyncio.AbstractEventLoop = None
+        # request id -> (index of the worker, queue of the caller)
+        self._pending: dict[int, tuple[int, asyncio.Queue]] = {}
+        self._ids = itertools.count()
+        self._stats: list[_WorkerStats] = []
+        self._draining = False
+        self._idle: asyncio.Event = None
+
+    def shard(self, session_id: str) -> int:
+        """The index of the worker of a session, the same in every process and run."""
+        return zlib.crc32(str(session_id).encode('utf-8')) % self.workers
+
+    async def start(self) -> WorkerPool:
+        self._loop = asyncio.get_running_loop()
+        self._responses = self._context.Queue()
+        for i in range(self.workers):
+            process, requests = self._spawn(i)
+            self._processes.append(process)
+            self._requests.append(requests)
+            self._stats.append(_WorkerStats())
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._reader = threading.Thread(target=self._read, name='crazyagent-pool-reader', daemon=True)
+        self._reader.start()
+        return self
+
+    def _spawn(self, index: int) -> tuple:
+        requests = self._context.Queue()
+        process = self._context.Process(
+            target=_worker_main,
+            args=(index, self.chat_factory, self.tools, self.store_factory, requests, self._responses),
+            name=f'crazyagent-worker-{index}',
+            daemon=True
+        )
+        process.start()
+        return process, requests
+
+    def _read(self) -> None:
+        """Route the messages of the workers to the callers, in a thread since the queue get is blocking."""
+        dead = set()
+        next_check = time.monotonic() + _HEALTH_INTERVAL
+        while True:
+            try:
+                request_id, kind, payload = self._responses.get(timeout=_HEALTH_INTERVAL)
+            except queue.Empty:
+                pass
+            else:
+                if kind == _EXIT:
+                    return
+                self._loop.call_soon_threadsafe(self._deliver, request_id, kind, payload)
+            if time.monotonic() >= next_check:
+                # A killed worker sends nothing, its callers would wait forever
+                for index, process in enumerate(list(self._processes)):
+                    if process not in dead and not process.is_alive():
+                        dead.add(process)
+                        self._loop.call_soon_threadsafe(self._died, index, process)
+                next_check = time.monotonic() + _HEALTH_INTERVAL
+
+    def _deliver(self, request_id: int, kind: str, payload) -> None:
+        pending = self._pending.get(request_id)
+        if pending is not None:
+            pending[1].put_nowait((kind, payload))
+
+    def _died(self, index: int, process) -> None:
+        """Fail the requests of a dead worker and replace it, unless the pool is stopping."""
+        if self._draining and process.exitcode == 0:
+            return
+        message = f'Worker {index} exited with code {process.exitcode} before the turn completed'
+        for worker, q in self._pending.values():
+            if worker == index:
+                q.put_nowait((_ERROR, message))
+        if self._draining or index >= len(self._processes) or self._processes[index] is not process:
+            return
+        # The requests still queued for the dead worker were failed above, the new one starts afresh
+        old_requests = self._requests[index]
+        old_requests.cancel_join_thread()
+        old_requests.close()
+        self._processes[index], self._requests[index] = self._spawn(index)
+        self._stats[index].restarts += 1
+
+    async def astream(
+        self,
+        session_id: str,
+        user_prompt: str,
+        temperature: float | None = None
+    ) -> AsyncIterator[Event]:
+        """Run a turn of the session in its worker, yielding the events of `Chat.astream_events`."""
+        if self._draining or not self._processes:
+            raise RuntimeError('WorkerPool is not accepting requests')
+        index = self.shard(session_id)
+        stats = self._stats[index]
+        request_id = next(self._ids)
+        q = asyncio.Queue()
+        self._pending[request_id] = (index, q)
+        stats.requests += 1
+        stats.active += 1
+        self._idle.clear()
+        started = time.monotonic()
+        try:
+            self._requests[index].put((request_id, None, (session_id, user_prompt, temperature)))
+            while True:
+                kind, payload = await q.get()
+                if kind == _EVENT:
+                    yield payload
+                elif kind == _END:
+                    return
+                else:
+                    stats.errors += 1
+                    raise WorkerError(payload)
+        finally:
+            # The turn goes on in the worker if the caller stops early, its events are discarded
+            del self._pending[request_id]
+            stats.active -= 1
+            stats.busy += time.monotonic() - started
+            if not self._pending:
+                self._idle.set()
+
+    async def ainvoke(self, session_id: str, user_prompt: str, temperature: float | None = None) -> Response:
+        """Run a turn of the session in its worker and return the final `Response`."""
+        content = []
+        # Closed on return, so the request is no longer counted as active
+        async with contextlib.aclosing(self.astream(session_id, user_prompt, temperature)) as events:
+            async for event in events:
+                if type(event) is TextDelta:
+                    content.append(event.content)
+                elif type(event) is Done:
+                    # The stream only sends the text as deltas
+                    response = event.response
+                    response.content = ''.join(content)
+                    return response
+
+    async def metrics(self) -> list[dict]:
+        """
+        The metrics of each worker, e.g.:
+            {
+                'worker': 0, 'alive': True, 'requests': 120, 'active': 3, 'errors': 0, 'busy': 95.2,
+                'restarts': 0, 'pid': 4242, 'sessions': 35, 'session_bytes': 81920, 'cpu_time': 12.5,
+                'max_rss_kb': 65536, 'uptime': 600.0
+            }
+        """
+        futures = []
+        for i, process in enumerate(self._processes):
+            request_id = next(self._ids)
+            q = asyncio.Queue()
+            self._pending[request_id] = (i, q)
+            self._requests[i].put((request_id, _METRICS, None))
+            futures.append((request_id, q, process))
+        result = []
+        for i, (request_id, q, process) in enumerate(futures):
+            stats = self._stats[i]
+            m = {
+                'worker': i,
+                'alive': process.is_alive(),
+                'requests': stats.requests,
+                'active': stats.active,
+                'errors': stats.errors,
+                'busy': stats.busy,
+                'restarts': stats.restarts
+            }
+            if m['alive']:
+                try:
+                    kind, worker_metrics = await asyncio.wait_for(q.get(), timeout=5)
+                    if kind == _METRICS:
+                        m.update(worker_metrics)
+                except asyncio.TimeoutError:
+                    pass
+            del self._pending[request_id]
+            result.append(m)
+        return result
+
+    async def stop(self, timeout: float = None) -> None:
+        """
+        Drain the pool: refuse new requests, wait for the running turns to complete (up to `timeout`
+        seconds, then the workers are terminated), and stop the workers.
+        """
+        if not self._processes:
+            return
+        self._draining = True
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            for process in self._processes:
+                process.terminate()
+        for requests in self._requests:
+            requests.put(None)
+        await asyncio.to_thread(self._join)
+        self._processes.clear()
+        self._requests.clear()
+        for _, q in self._pending.values():
+            q.put_nowait((_ERROR, 'WorkerPool stopped before the turn completed'))
+
+    def _join(self) -> None:
+        for process in self._processes:
+            process.join()
+        # Every message of the workers is queued before they exit, the reader stops after them
+        self._responses.put((None, _EXIT, None))
+        self._reader.join()
+
+    async def __aenter__(self) -> WorkerPool:
+        return await self.start()
+
+    async def __aexit__(self, *exc) -> None:
+        await self.stop()
+
+__all__ = [
+    'WorkerPool',
+    'WorkerError'
+]